@@ -0,0 +1,41 @@
+
+import ConfigParser
+import logging
+import os
+import sys
+from obd_archive import ArchiveStore
+
+# Restore files from the content-addressed archive store
+#
+#   python obd-archive-restore.py                                 List the archived runs
+#   python obd-archive-restore.py <run>                           List the files archived by a run
+#   python obd-archive-restore.py <run> <directory> [file ...]    Restore the files of a run to a directory
+
+Config = ConfigParser.ConfigParser()
+Config.read('azure.ini')
+
+logger = logging.getLogger('base')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s [%(levelname)s] obd-archive "%(message)s"')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+if not Config.has_option('working', 'archive_store'):
+    logger.error('No archive_store is configured in azure.ini')
+    sys.exit(1)
+
+store = ArchiveStore(Config.get('working', 'archive_store'))
+
+if len(sys.argv) < 2:
+    for run in store.runs():
+        print(run)
+elif len(sys.argv) == 2:
+    for entry in store.manifest(sys.argv[1]):
+        print('{0}  {1:>12}  {2}'.format(entry['hash'], entry['size'], entry['name']))
+else:
+    if not os.path.isdir(sys.argv[2]):
+        os.makedirs(sys.argv[2])
+    restored = store.restore(sys.argv[1], sys.argv[2], sys.argv[3:])
+    logger.info('Restored {0} files to {1}'.format(len(restored), sys.argv[2]))
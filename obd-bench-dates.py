@@ -0,0 +1,39 @@
+
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+from dateutil import parser as dateparser
+from obd_dates import date_cache, parse_date
+
+# Benchmark comparing obd_dates.parse_date with dateutil on a catalog-sized sample of expiry and
+# publication dates, in the formats written by the conversion.
+# Usage: python obd-bench-dates.py [number of dates]
+
+sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+random.seed(42)
+start = datetime(2018, 1, 1)
+values = []
+for i in range(sample_size):
+    kind = random.random()
+    if kind < 0.6:
+        # Default expiry dates are rounded to the hour, so many records share them
+        values.append((start + timedelta(hours=random.randint(0, 24 * 365 * 2))).isoformat())
+    elif kind < 0.9:
+        values.append((start + timedelta(seconds=random.randint(0, 3600 * 24 * 365))).strftime("%Y-%m-%d %H:%M:%S"))
+    else:
+        values.append((start + timedelta(days=random.randint(0, 3650))).strftime("%Y-%m-%d"))
+
+for value in values[:1000]:
+    assert parse_date(value) == dateparser.parse(value), value
+date_cache.clear()
+
+dateutil_time = min(timeit.repeat(lambda: [dateparser.parse(v) for v in values], number=1, repeat=3))
+cold_time = timeit.timeit(lambda: [parse_date(v) for v in values], number=1)
+warm_time = min(timeit.repeat(lambda: [parse_date(v) for v in values], number=1, repeat=3))
+
+print('{0} dates, {1} distinct'.format(len(values), len(set(values))))
+print('dateutil.parser.parse  {0:8.3f} s'.format(dateutil_time))
+print('parse_date (cold)      {0:8.3f} s  {1:6.1f}x'.format(cold_time, dateutil_time / cold_time))
+print('parse_date (warm)      {0:8.3f} s  {1:6.1f}x'.format(warm_time, dateutil_time / warm_time))
@@ -0,0 +1,78 @@
+
+import hashlib
+import os
+import shutil
+import sys
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from obd_hash import hash_file
+from tempfile import mkdtemp
+
+# Benchmark comparing obd_hash.hash_file with the previous 4 KiB read loop, on a set of generated files the
+# size of GCDocs documents. The files are hashed one after the other and then on a pool of threads.
+# Usage: python obd-bench-hash.py [number of files] [file size in MiB] [threads]
+
+file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+file_size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 16 * 1024 * 1024
+threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+
+def small_read_sha384(file_to_hash):
+    hash_sha = hashlib.sha384()
+    with open(file_to_hash, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_sha.update(chunk)
+    return hash_sha.hexdigest()
+
+
+def small_read_md5_sha384(file_to_hash):
+    # The md5 and the SHA 384 hash used to be computed by reading the file twice
+    hash_md5 = hashlib.md5()
+    with open(file_to_hash, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest(), small_read_sha384(file_to_hash)
+
+
+def engine_sha384(file_to_hash):
+    return hash_file(file_to_hash)['sha384']
+
+
+def engine_md5_sha384(file_to_hash):
+    hashes = hash_file(file_to_hash, ('md5', 'sha384'))
+    return hashes['md5'], hashes['sha384']
+
+
+work_dir = mkdtemp()
+try:
+    files = []
+    block = os.urandom(1024 * 1024)
+    for i in range(file_count):
+        file_name = os.path.join(work_dir, '{0}.pdf'.format(i))
+        with open(file_name, 'wb') as f:
+            for offset in range(0, file_size, len(block)):
+                f.write(block[:file_size - offset])
+        files.append(file_name)
+
+    for file_name in files[:2]:
+        assert engine_sha384(file_name) == small_read_sha384(file_name)
+        assert engine_md5_sha384(file_name) == small_read_md5_sha384(file_name)
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    results = []
+    for label, function in [('4 KiB reads, sha384', small_read_sha384),
+                            ('hash_file, sha384', engine_sha384),
+                            ('4 KiB reads, md5 + sha384', small_read_md5_sha384),
+                            ('hash_file, md5 + sha384', engine_md5_sha384)]:
+        serial_time = min(timeit.repeat(lambda: [function(f) for f in files], number=1, repeat=3))
+        pool_time = min(timeit.repeat(lambda: list(executor.map(function, files)), number=1, repeat=3))
+        results.append((label, serial_time, pool_time))
+    executor.shutdown()
+
+    total_mib = file_count * file_size / (1024.0 * 1024.0)
+    print('{0} files of {1:.1f} MiB, {2} threads'.format(file_count, file_size / (1024.0 * 1024.0), threads))
+    for label, serial_time, pool_time in results:
+        print('{0:28} {1:8.3f} s {2:8.1f} MiB/s   threads {3:8.3f} s {4:8.1f} MiB/s'.format(
+            label, serial_time, total_mib / serial_time, pool_time, total_mib / pool_time))
+finally:
+    shutil.rmtree(work_dir)
@@ -0,0 +1,271 @@
+import BaseHTTPServer
+import SocketServer
+import cgi
+import logging
+import os
+import random
+import re
+import shutil
+import simplejson as json
+import sys
+import threading
+import time
+import uuid
+import azure.storage.blob
+from azure.common import AzureMissingResourceHttpError
+from tempfile import mkdtemp
+
+# Benchmark of obd_03 against a local stand-in for the CKAN action API. The stand-in answers after a fixed latency,
+# and slows down and refuses calls above its capacity like an overloaded portal. For each configuration, obd_03 is
+# run on a JSON lines file of new records, and then on a file where half of the records changed. The end state of
+# the stand-in must be the same as with a single upload worker. Blob storage is replaced by a stand-in holding no
+# files, since the resources are uploaded through CKAN.
+# Usage: python obd-bench-upload.py [number of records] [latency in ms] [stand-in capacity]
+
+record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+# Records in flight and highest number of CKAN calls in flight
+CONFIGURATIONS = [(1, 1), (8, 8), (32, 8), (64, 16), (64, 64)]
+
+OBD_03 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'obd_03_upload.py')
+
+AZURE_INI = '''[azure-blob-storage]
+account_name: bench
+account_key: bench
+account_obd_container: obd
+account_gcdocs_container: gcdocs
+[ckan]
+remote_url: {portal_url}
+remote_api_key: key
+ckan_max_concurrency: {max_concurrency}
+ckan_max_retries: 8
+ckan_backoff_seconds: 0.05
+ckan_latency_target: {latency_target}
+ckan_breaker_failures: 0
+[web]
+user_agent: obd-bench-upload
+[working]
+ckanjson_directory: {work_dir}/jsonl
+intake_directory: {work_dir}/intake
+archive_directory: {work_dir}/archive
+error_logfile: {work_dir}/obd_03.log
+publication_ledger: {work_dir}/publications.db
+upload_workers: {workers}
+'''
+
+
+class StandInPortal(object):
+    """
+    Datasets and resources held by the stand-in, and the calls it received
+    """
+
+    def __init__(self):
+        self.packages = {}
+        self.calls = 0
+        self.refused = 0
+        self.active = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_resource(params):
+        resource = dict(params)
+        resource['id'] = str(uuid.uuid4())
+        if 'name_translated' in resource:
+            resource['name'] = resource['name_translated']['en']
+        return resource
+
+    def package_show(self, params):
+        if params['id'] not in self.packages:
+            raise KeyError(params['id'])
+        return self.packages[params['id']]
+
+    def package_search(self, params):
+        ids = re.match(r'id:\((.*)\)', params['fq']).group(1).split(' OR ')
+        results = [self.packages[i] for i in ids if i in self.packages]
+        return {'count': len(results), 'results': results}
+
+    def package_create(self, params):
+        package = dict(params)
+        package['resources'] = [self.new_resource(r) for r in params.get('resources', [])]
+        self.packages[package['id']] = package
+        return package
+
+    def package_patch(self, params):
+        package = self.packages[params['id']]
+        package.update((k, v) for k, v in params.items() if k != 'resources')
+        return package
+
+    def resource_create(self, params):
+        resource = self.new_resource(params)
+        self.packages[params['package_id']]['resources'].append(resource)
+        return resource
+
+    def resource_patch(self, params):
+        for package in self.packages.values():
+            for resource in package['resources']:
+                if resource['id'] == params['id']:
+                    resource.update(params)
+                    return resource
+        raise KeyError(params['id'])
+
+    def end_state(self):
+        return sorted((package['id'], package['title_translated']['en'],
+                       [(r['name'], r['hash'], r.get('size')) for r in package['resources']])
+                      for package in self.packages.values())
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one packet, so keep-alive calls are not held up by delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.headers.getheader('Content-Type', '').startswith('multipart'):
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={'REQUEST_METHOD': 'POST'})
+            params = dict((k, form[k].value) for k in form.keys() if not form[k].filename)
+            params['size'] = sum(len(form[k].value) for k in form.keys() if form[k].filename)
+        else:
+            params = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))) or '{}')
+        portal = self.server.portal
+        with portal.lock:
+            portal.active += 1
+            busy = portal.active
+            portal.calls += 1
+        try:
+            overload = max(0, busy - capacity)
+            time.sleep(latency * (1 + 2 * overload))
+            if overload and random.random() < 0.15 * overload:
+                with portal.lock:
+                    portal.refused += 1
+                return self.reply(503, {'success': False, 'error': {'message': 'Overloaded'}})
+            with portal.lock:
+                try:
+                    result = getattr(portal, self.path.rsplit('/', 1)[1])(params)
+                except KeyError:
+                    return self.reply(404, {'success': False,
+                                            'error': {'__type': 'Not Found Error', 'message': 'Not found'}})
+            self.reply(200, {'success': True, 'result': result})
+        finally:
+            with portal.lock:
+                portal.active -= 1
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class StandInBlobService(object):
+    """
+    Blob storage holding no files. obd_03 only reads it to hash resources uploaded without a recorded hash.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_blob_to_stream(self, container, blob_name, stream, **kwargs):
+        raise AzureMissingResourceHttpError('Not found', 404)
+
+
+def write_records(work_dir, version):
+    """
+    Write the JSON lines file and the GCDocs documents read by obd_03. Half of the records change in version 1.
+    """
+    random.seed(version)
+    with open(os.path.join(work_dir, 'jsonl', 'ckan_obd_bench_{0}.jsonl'.format(version)), 'w') as jl_file:
+        for i in range(record_count):
+            changed = ' v2' if version and random.random() < 0.5 else ''
+            name = '{0}.pdf'.format(i)
+            record = {'id': str(uuid.uuid5(uuid.NAMESPACE_URL, 'http://obd.open.canada.ca/{0}'.format(i))),
+                      'collection': 'publication',
+                      'date_expires': '2099-01-01T00:00:00',
+                      'title_translated': {'en': 'Document {0}{1}'.format(i, changed),
+                                           'fr': 'Document {0}{1}'.format(i, changed)},
+                      'resources': [{'name_translated': {'en': name, 'fr': name},
+                                     'url': 'http://obd.open.canada.ca/' + name,
+                                     'format': 'PDF'}]}
+            jl_file.write(json.dumps(record) + '\n')
+            with open(os.path.join(work_dir, 'intake', name), 'wb') as document:
+                document.write('GCDocs document {0}{1}'.format(i, changed) * 200)
+
+
+def run_obd_03(work_dir):
+    """
+    Run obd_03 in this process, in the working directory holding its azure.ini
+    :return: Tuple of the elapsed time and of the CKAN client of the run
+    """
+    namespace = {'__name__': '__main__', '__file__': OBD_03}
+    logger = logging.getLogger('base')
+    handlers = logger.handlers[:]
+    current_dir, stderr = os.getcwd(), sys.stderr
+    start = time.time()
+    try:
+        os.chdir(work_dir)
+        # obd_03 logs each record to the console
+        sys.stderr = open(os.devnull, 'w')
+        execfile(OBD_03, namespace)
+    except SystemExit:
+        pass
+    finally:
+        elapsed = time.time() - start
+        sys.stderr.close()
+        sys.stderr = stderr
+        os.chdir(current_dir)
+        for handler in logger.handlers[:]:
+            if handler not in handlers:
+                logger.removeHandler(handler)
+                handler.close()
+    return elapsed, namespace['ckan']
+
+
+# obd_03 creates its blob service when it needs one
+azure.storage.blob.BlockBlobService = StandInBlobService
+
+server = StandInServer(('127.0.0.1', 0), StandInHandler)
+server_thread = threading.Thread(target=server.serve_forever)
+server_thread.daemon = True
+server_thread.start()
+portal_url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+print('{0} records, {1:.0f} ms latency, stand-in capacity {2} calls'.format(record_count, latency * 1000,
+                                                                           capacity))
+print('{0:>8} {1:>9} {2:>10} {3:>10} {4:>8} {5:>8} {6:>12}'.format(
+    'records', 'ckan', 'upload', 'update', 'calls', 'refused', 'concurrency'))
+expected_state = None
+for workers, max_concurrency in CONFIGURATIONS:
+    server.portal = StandInPortal()
+    work_dir = mkdtemp()
+    try:
+        for sub_dir in ('jsonl', 'intake', 'archive'):
+            os.mkdir(os.path.join(work_dir, sub_dir))
+        with open(os.path.join(work_dir, 'azure.ini'), 'w') as ini_file:
+            ini_file.write(AZURE_INI.format(portal_url=portal_url, max_concurrency=max_concurrency,
+                                            latency_target=latency * 4, work_dir=work_dir, workers=workers))
+        times = []
+        for version in (0, 1):
+            write_records(work_dir, version)
+            elapsed, ckan = run_obd_03(work_dir)
+            times.append(elapsed)
+    finally:
+        shutil.rmtree(work_dir)
+    end_state = server.portal.end_state()
+    if expected_state is None:
+        expected_state = end_state
+    print('{0:>8} {1:>9} {2:>8.2f} s {3:>8.2f} s {4:>8} {5:>8} {6:>5} to {7:<4}{8}'.format(
+        workers, max_concurrency, times[0], times[1], server.portal.calls, server.portal.refused,
+        ckan.limiter.lowest, int(ckan.limiter.limit), '' if end_state == expected_state else '  END STATE DIFFERS'))
+server.shutdown()
@@ -0,0 +1,92 @@
+
+import os
+import resource
+import subprocess
+import sys
+import timeit
+from obd_xml import read_xml, read_xml_tree
+from tempfile import mkstemp
+
+# Micro-benchmark comparing the streaming GCDocs XML parser with the original tree parser.
+# Usage: python obd-bench-xml.py [number of customMetadata rows ...]
+
+XML_HEAD = '''<?xml version="1.0" encoding="UTF-8"?>
+<enterpriseLibrary>
+  <application>
+    <parent>
+      <item>
+        <variants>
+          <variant>
+            <properties>
+              <property name="Title English"><value>Synthetic export</value></property>
+              <property name="Title French"><value>Exportation synthetique</value></property>
+              <property name="Language"><value>eng</value></property>
+              <property name="Empty"><value/></property>
+              <propertyGroup name="customMetadata">
+'''
+
+XML_ROW = '''                <propertyRow>
+                  <property name="attribute"><value>Attribute {0}</value></property>
+                  <property name="metadata"><value>Metadata value {0} {1}</value></property>
+                </propertyRow>
+'''
+
+XML_TAIL = '''              </propertyGroup>
+            </properties>
+          </variant>
+        </variants>
+      </item>
+    </parent>
+  </application>
+</enterpriseLibrary>
+'''
+
+
+def make_export(rows):
+    """
+    Write a synthetic GCDocs export with the requested number of customMetadata rows
+    :param rows: Number of propertyRow elements
+    :return: Path to the temporary XML file
+    """
+    fd, filename = mkstemp(suffix='.xml')
+    padding = 'x' * 200
+    with os.fdopen(fd, 'w') as xml_file:
+        xml_file.write(XML_HEAD)
+        for i in range(rows):
+            xml_file.write(XML_ROW.format(i, padding))
+        xml_file.write(XML_TAIL)
+    return filename
+
+
+def measure_peak_memory(parser, filename):
+    """
+    Run the parser in a fresh interpreter so its peak resident memory is not polluted by earlier runs
+    :return: Peak resident set size in KiB
+    """
+    return int(subprocess.check_output([sys.executable, __file__, '--memory', parser.__name__, filename]))
+
+
+if len(sys.argv) == 4 and sys.argv[1] == '--memory':
+    {'read_xml': read_xml, 'read_xml_tree': read_xml_tree}[sys.argv[2]](sys.argv[3])
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    sys.exit(0)
+
+if len(sys.argv) > 1:
+    sizes = [int(a) for a in sys.argv[1:]]
+else:
+    sizes = [1000, 10000, 100000]
+
+print('{0:>10} {1:>10} {2:>12} {3:>12} {4:>12} {5:>12}'.format(
+    'rows', 'size KiB', 'tree ms', 'stream ms', 'tree KiB', 'stream KiB'))
+for size in sizes:
+    export_file = make_export(size)
+    try:
+        assert read_xml(export_file) == read_xml_tree(export_file)
+        repeat = max(1, 100000 // size)
+        tree_time = min(timeit.repeat(lambda: read_xml_tree(export_file), number=repeat, repeat=3)) / repeat
+        stream_time = min(timeit.repeat(lambda: read_xml(export_file), number=repeat, repeat=3)) / repeat
+        print('{0:>10} {1:>10} {2:>12.2f} {3:>12.2f} {4:>12} {5:>12}'.format(
+            size, os.path.getsize(export_file) // 1024, tree_time * 1000, stream_time * 1000,
+            measure_peak_memory(read_xml_tree, export_file), measure_peak_memory(read_xml, export_file)))
+    finally:
+        os.remove(export_file)
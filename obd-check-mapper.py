@@ -0,0 +1,217 @@
+
+import itertools
+import logging
+import os
+import random
+import simplejson as json
+import sys
+import time
+import timeit
+import uuid
+from datetime import datetime
+from obd_convert import convert, convert_resource, oc_audience_types, oc_organizations
+from obd_dates import parse_date
+from obd_mapper import MissingRequiredFieldException
+
+# Conformance check of the compiled field mapping in convert() against the original hand-written
+# convert_legacy(). A generated corpus covering the present, missing and malformed variants of every
+# mapped GCDocs field is always checked. Directories of intake JSON files written by obd_01 can be added.
+# Usage: python obd-check-mapper.py [intake directory ...]
+
+FIELD_VARIANTS = {
+    'Expiration Date': [None, '2040-06-01T00:00:00', '2001-01-01T00:00:00'],
+    'Date Created': [None, '2018-03-01'],
+    'Publisher Organization': [None, 'Canadian Heritage|Patrimoine canadien', 'Environment Canada',
+                               'Unknown Department|Ministere inconnu'],
+    'Subject': [None, 'health,safety|sante,securite', 'no french keywords', 'a|b|c'],
+    'subject': [None, 'economics'],
+    'Audience': [None, 'Business', 'Not an audience'],
+    'Title English': [None, 'English title'],
+    'Title French': [None, 'Titre francais'],
+    'Classification Code': [None, '1234-56'],
+    'Date Modified': [None, '2018-04-01'],
+    'Creator': [None, 'Jane Doe'],
+    'Description English': [None, 'English description'],
+    'Description French': [None, 'Description francaise'],
+    'Publisher Organization- Section': [None, 'Open Government|Gouvernement ouvert', 'One language only'],
+    'Language': [None, 'eng', 'fra', 'zxx'],
+    'Language/Langue': [None, 'EN', 'fr', 'other'],
+    'Resource Type': [None, 'Guide|Guide', 'Unknown type'],
+}
+
+FILE_NAMES = ['12345.pdf', '12345.docx', '12345']
+
+logger = logging.getLogger('base')
+
+
+def convert_legacy(fields, filename):
+    """
+    Convert the basic imported JSON document metadata to CKAN Package JSON with the original hand-written
+    field mapping, the reference for the compiled mapping used by obd_convert.convert()
+    :param fields: JSON file notation
+    :param filename: CKAN JSON lines files to write to
+    :return: CKAN package object
+    """
+
+    # Initialize the record
+    obd_ds = {'collection': 'publication',
+              'id': str(uuid.uuid5(uuid.NAMESPACE_URL, 'http://obd.open.canada.ca/' + os.path.splitext(filename)[0]))}
+
+    # Check Expiration date first. If the document has expired, then most of these fields will NOT be present
+
+    if 'Expiration Date' in fields:
+        obd_ds['date_expires'] = fields['Expiration Date']
+    else:
+        right_now = datetime.utcnow()
+        default_expiry = datetime(right_now.year + 2, right_now.month, right_now.day, right_now.hour, 0, 0)
+        obd_ds['date_expires'] = default_expiry.isoformat()
+    expiry_date = parse_date(obd_ds['date_expires'])
+
+    if expiry_date > datetime.utcnow():
+
+        # Perform conversion
+
+        release_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if 'Date Created' in fields:
+            obd_ds['date_published'] = fields['Date Created']
+        else:
+            obd_ds['date_published'] = release_date
+
+        obd_ds['state'] = 'active'
+        obd_ds['type'] = 'doc'
+        obd_ds['license_id'] = "ca-ogl-lgo"
+
+        if 'Publisher Organization' in fields:
+            org_name = fields['Publisher Organization'].split('|')[0].strip()
+        else:
+            org_name = 'Treasury Board of Canada Secretariat'
+        if org_name in oc_organizations:
+            obd_ds['owner_org'] = oc_organizations[org_name]
+        else:
+            obd_ds['owner_org'] = oc_organizations['Treasury Board of Canada Secretariat']
+        obd_ds['keywords'] = {}
+        if 'Subject' in fields:
+            keywords_by_lang = fields['Subject'].split('|')
+            if len(keywords_by_lang) == 2:
+                obd_ds['keywords']['en'] = keywords_by_lang[0].split(',')
+                obd_ds['keywords']['fr'] = keywords_by_lang[1].split(',')
+        if not fields.get('subject', None):
+            obd_ds['subject'] = ["information_and_communications"]
+
+        if 'Audience' in fields:
+            if fields['Audience'] in oc_audience_types:
+                obd_ds['audience'] = oc_audience_types[fields['Audience']]
+
+        # Use unilingual titles where appropriate
+        obd_ds['title_translated'] = {}
+        if ('Title English' not in fields) and ('Title French' not in fields):
+            raise MissingRequiredFieldException("Missing Title fields")
+        if 'Title French' not in fields:
+            obd_ds['title_translated']['fr'] = fields['Title English']
+        else:
+            obd_ds['title_translated']['fr'] = fields['Title French']
+        if 'Title English' not in fields:
+            obd_ds['title_translated']['en'] = fields['Title French']
+        else:
+            obd_ds['title_translated']['en'] = fields['Title English']
+
+        if 'Classification Code' in fields:
+            obd_ds['doc_classification_code'] = fields['Classification Code']
+
+        if 'Date Modified' in fields:
+            obd_ds['date_modified'] = fields['Date Modified']
+
+        if 'Creator' in fields:
+            obd_ds['creator'] = fields['Creator']
+        obd_ds['notes_translated'] = {}
+        if 'Description English' in fields:
+            obd_ds['notes_translated']['en'] = fields['Description English']
+        if 'Description French' in fields:
+            obd_ds['notes_translated']['fr'] = fields['Description French']
+
+        if 'Publisher Organization- Section' in fields:
+            org_section = fields['Publisher Organization- Section'].split('|')
+            if len(org_section) == 2:
+                obd_ds['org_section'] = {}
+                obd_ds['org_section']['en'] = org_section[0]
+                obd_ds['org_section']['fr'] = org_section[1]
+
+        # The Usage Condition is not currently being set.
+        obd_ds['usage_condition'] = {}
+
+        # The maintainer e-mail is not currently provided by OBD so it is set to
+        # open-ouvert@tbs-sct.gc.ca
+        obd_ds['maintainer_email'] = 'open-ouvert@tbs-sct.gc.ca'
+
+        logger.info('Processed incoming XML for document {0}'.format(fields['GCfile']))
+
+    obd_ds['resources'] = [convert_resource(fields, filename, expiry_date > datetime.utcnow())]
+    return obd_ds
+
+
+def generated_corpus(size):
+    """
+    Generate GCDocs metadata records. Every variant of every field is used at least once, the rest of the
+    corpus is random combinations.
+    """
+    random.seed(1)
+    names = sorted(FIELD_VARIANTS)
+    for i in itertools.count():
+        if i >= size and i >= max(len(v) for v in FIELD_VARIANTS.values()):
+            break
+        fields = {'GCID': str(10000 + i), 'GCfile': FILE_NAMES[i % len(FILE_NAMES)]}
+        for name in names:
+            variants = FIELD_VARIANTS[name]
+            value = variants[i] if i < len(variants) else random.choice(variants)
+            if value is not None:
+                fields[name] = value
+        yield fields
+
+
+def intake_corpus(directories):
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for json_file in sorted(files):
+                if json_file.endswith('.json'):
+                    with open(os.path.join(root, json_file), 'r') as json_filed:
+                        yield json.load(json_filed)
+
+
+def run_convert(function, fields):
+    """
+    :return: The converted record, or the type and message of the exception raised
+    """
+    try:
+        obd_ds = function(fields, fields['GCfile'])
+    except Exception as ex:
+        return type(ex).__name__, str(ex)
+    # These default to the current time, and may differ between the two calls
+    if 'Date Created' not in fields:
+        obd_ds.pop('date_published', None)
+    if 'Expiration Date' not in fields:
+        obd_ds.pop('date_expires', None)
+    return obd_ds
+
+
+corpus = list(generated_corpus(5000)) + list(intake_corpus(sys.argv[1:]))
+failures = 0
+for record in corpus:
+    expected = run_convert(convert_legacy, record)
+    actual = run_convert(convert, record)
+    if expected != actual:
+        failures += 1
+        print('Mismatch for {0}'.format(json.dumps(record, sort_keys=True)))
+        print('  expected: {0}'.format(json.dumps(expected, sort_keys=True)))
+        print('  actual:   {0}'.format(json.dumps(actual, sort_keys=True)))
+
+# Best of several runs of processor time, taking turns so that both see the same load on the machine. A single
+# run varies too much to compare the two.
+legacy_time = mapped_time = float('inf')
+for i in range(20):
+    legacy_time = min(legacy_time, timeit.timeit(lambda: [run_convert(convert_legacy, r) for r in corpus],
+                                                 number=1, timer=time.clock))
+    mapped_time = min(mapped_time, timeit.timeit(lambda: [run_convert(convert, r) for r in corpus],
+                                                 number=1, timer=time.clock))
+print('{0} records checked, {1} mismatches'.format(len(corpus), failures))
+print('convert_legacy {0:.3f} s, convert {1:.3f} s'.format(legacy_time, mapped_time))
+sys.exit(1 if failures else 0)
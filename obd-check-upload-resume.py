@@ -0,0 +1,117 @@
+
+import hashlib
+import os
+import shutil
+import sys
+import threading
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from obd_blocks import block_size_for, upload_blocks
+from tempfile import mkdtemp
+
+# Check that a resource upload to blob storage that fails part way is resumed by the next attempt, which only
+# sends the blocks that were not stored, and that a changed file only sends its changed blocks. The blocks are
+# sent to an in-memory stand-in for the block blob API, which can fail after a number of blocks.
+# Usage: python obd-check-upload-resume.py [file size in MiB]
+
+file_size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 40 * 1024 * 1024
+
+
+class StandInBlockList(object):
+
+    def __init__(self, committed_blocks, uncommitted_blocks):
+        self.committed_blocks = committed_blocks
+        self.uncommitted_blocks = uncommitted_blocks
+
+
+class StandInBlock(object):
+
+    def __init__(self, block_id):
+        self.id = block_id
+
+
+class StandInBlobService(object):
+    """
+    Block blob calls used by obd_blocks.upload_blocks. Staged blocks are kept until the blob is committed.
+    """
+
+    def __init__(self):
+        self.staged = {}
+        self.committed = {}
+        self.blobs = {}
+        self.blocks_sent = 0
+        self.fail_after = None
+        self.lock = threading.Lock()
+
+    def put_block(self, container, blob_name, block, block_id):
+        with self.lock:
+            if self.fail_after is not None and self.blocks_sent >= self.fail_after:
+                raise AzureHttpError('Server busy', 503)
+            self.blocks_sent += 1
+            self.staged.setdefault(blob_name, {})[block_id] = block
+
+    def get_block_list(self, container, blob_name, block_list_type=None):
+        with self.lock:
+            if blob_name not in self.staged and blob_name not in self.committed:
+                raise AzureMissingResourceHttpError('Not found', 404)
+            return StandInBlockList([StandInBlock(i) for i in self.committed.get(blob_name, {})],
+                                    [StandInBlock(i) for i in self.staged.get(blob_name, {})])
+
+    def put_block_list(self, container, blob_name, block_list, content_settings=None):
+        with self.lock:
+            blocks = dict(self.committed.get(blob_name, {}))
+            blocks.update(self.staged.pop(blob_name, {}))
+            self.committed[blob_name] = dict((b.id, blocks[b.id]) for b in block_list)
+            self.blobs[blob_name] = b''.join(blocks[b.id] for b in block_list)
+
+
+def sha384(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha384(f.read()).hexdigest()
+
+
+def upload(blob_service, local_name, fail_after=None):
+    """
+    :return: Tuple of the number of blocks sent and of blocks already in storage, or None if the upload failed
+    """
+    blob_service.fail_after = fail_after
+    blob_service.blocks_sent = 0
+    try:
+        return upload_blocks(lambda: blob_service, 'obd', 'resources/check/document.pdf', local_name,
+                             connections=4, content_type='application/pdf')
+    except AzureHttpError:
+        return None
+
+
+def check(label, passed):
+    print('{0:60} {1}'.format(label, 'ok' if passed else 'FAILED'))
+    return passed
+
+
+work_dir = mkdtemp()
+try:
+    local_name = os.path.join(work_dir, 'document.pdf')
+    with open(local_name, 'wb') as f:
+        f.write(os.urandom(file_size))
+    block_count = -(-file_size // block_size_for(file_size))
+    service = StandInBlobService()
+
+    results = [check('{0} blocks, the first attempt fails after 2 blocks'.format(block_count),
+                     upload(service, local_name, fail_after=2) is None and not service.blobs)]
+    resumed = upload(service, local_name)
+    results.append(check('The retry only sends the blocks that were not stored',
+                         resumed == (block_count - 2, 2)))
+    results.append(check('The committed blob is the file',
+                         hashlib.sha384(service.blobs['resources/check/document.pdf']).hexdigest() ==
+                         sha384(local_name)))
+
+    with open(local_name, 'r+b') as f:
+        f.seek(file_size // 2)
+        f.write(b'changed')
+    results.append(check('A changed file only sends its changed block',
+                         upload(service, local_name) == (1, block_count - 1)))
+    results.append(check('The committed blob is the changed file',
+                         hashlib.sha384(service.blobs['resources/check/document.pdf']).hexdigest() ==
+                         sha384(local_name)))
+finally:
+    shutil.rmtree(work_dir)
+sys.exit(0 if all(results) else 1)
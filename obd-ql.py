@@ -1,10 +1,10 @@
 from ckan.logic import NotFound
 from ckan.lib.munge import munge_filename
 from ckanapi.errors import CKANAPIError
-from ckanapi import RemoteCKAN
 import ConfigParser
+from obd_ckan import PortalUnavailable, ckan_client
+from obd_ledger import PublicationLedger
 import os
-import requests.exceptions
 import simplejson as json
 import sys
 from termcolor import cprint
@@ -15,6 +15,25 @@ import uuid
 Config = ConfigParser.ConfigParser()
 Config.read('azure.ini')
 
+# CKAN API client shared by all the calls
+ckan = ckan_client(Config)
+
+# Publication ledger of obd_03. Datasets changed here are removed from it, so obd_03 looks them up in CKAN again
+# instead of trusting the resource hash and metadata digest it recorded.
+publication_ledger = None
+if Config.has_option('working', 'publication_ledger'):
+    publication_ledger = PublicationLedger(Config.get('working', 'publication_ledger'))
+
+
+def forget_publication(package_id):
+    """
+    Remove a dataset changed by this script from the obd_03 publication ledger
+    :param package_id: CKAN package ID
+    :return: Nothing
+    """
+    if publication_ledger:
+        publication_ledger.remove(package_id)
+
 
 def get_ckan_record(record_id):
     """
@@ -23,23 +42,20 @@ def get_ckan_record(record_id):
     :return: The CKAN package, or an empty dict if the dataset could not be retrieved
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    user_agent = Config.get('web', 'user_agent')
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent) as ckan_instance:
-        package_record = {}
-        try:
-            package_record = ckan_instance.action.package_show(id=record_id)
+    package_record = {}
+    try:
+        package_record = ckan.anonymous.action.package_show(id=record_id)
 
-        except NotFound:
-            # This is a new record!
-            cprint('Record {0} does not exist'.format(record_id), 'yellow')
-        except requests.exceptions.ConnectionError as ce:
-            cprint('get_ckan_record(): Fatal connection error {0}'.format(ce.message), 'red', attrs=['blink'])
-            exit(code=500)
-        except CKANAPIError as ne:
-            cprint('get_ckan_record(): Unexpected error {0}'.format(ne.message), 'yellow')
+    except NotFound:
+        # This is a new record!
+        cprint('Record {0} does not exist'.format(record_id), 'yellow')
+    except PortalUnavailable as ce:
+        cprint('get_ckan_record(): Portal unavailable {0}'.format(ce.message), 'red', attrs=['blink'])
+        exit(code=500)
+    except CKANAPIError as ne:
+        cprint('get_ckan_record(): Unexpected error {0}'.format(ne.message), 'yellow')
 
-        return package_record
+    return package_record
 
 
 def add_ckan_record(package_dict):
@@ -49,51 +65,48 @@ def add_ckan_record(package_dict):
     :return: The created package
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
     new_package = None
-
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            new_package = ckan_instance.action.package_create(**package_dict)
-            cprint('Created new record {0}'.format(new_package['id']), 'green')
-        except Exception as ex:
-            cprint("Unable to create new portal record {0}".format(ex.message), 'yellow')
+    try:
+        new_package = ckan.authorized.action.package_create(**package_dict)
+        forget_publication(new_package['id'])
+        cprint('Created new record {0}'.format(new_package['id']), 'green')
+    except Exception as ex:
+        cprint("Unable to create new portal record {0}".format(ex.message), 'yellow')
     return new_package
 
 
 def update_resource(package_id, resource_file, idx):
     """
-    Add or update the resource file for the dataset
+    Add or update the resource file for the dataset. The hash recorded by obd_03 is cleared, and the dataset
+    is removed from the publication ledger, so obd_03 compares the next GCDocs file with the file uploaded here.
     :param package_id: OBD dataset ID
     :param resource_file: path to the resource file
     :return: Nothing
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            package_record = ckan_instance.action.package_show(id=package_id)
-        except NotFound as nf:
-            cprint("Unable to find record {0} to update".format(nf.message), 'yellow')
-            return
-
-        try:
-            if len(package_record['resources']) < idx:
-                ckan_instance.action.resource_create(package_id=package_id,
-                                                     url='',
-                                                     upload=open(resource_file, 'rb'))
-                cprint("Added new resource to {0}".format(package_id), 'green')
-            else:
-                ckan_instance.action.resource_patch(id=package_record['resources'][idx]['id'],
-                                                    url='',
-                                                    upload=open(resource_file, 'rb'))
-                cprint("Updated resource {0} for record {1}".format(idx, package_id), 'green')
-        except CKANAPIError as ce:
-            cprint(ce.message, 'yellow')
+    try:
+        package_record = ckan.authorized.action.package_show(id=package_id)
+    except NotFound as nf:
+        cprint("Unable to find record {0} to update".format(nf.message), 'yellow')
+        return
+
+    try:
+        if len(package_record['resources']) < idx:
+            ckan.authorized.action.resource_create(package_id=package_id,
+                                                   url='',
+                                                   hash='',
+                                                   upload=open(resource_file, 'rb'))
+            forget_publication(package_id)
+            cprint("Added new resource to {0}".format(package_id), 'green')
+        else:
+            ckan.authorized.action.resource_patch(id=package_record['resources'][idx]['id'],
+                                                  url='',
+                                                  hash='',
+                                                  upload=open(resource_file, 'rb'))
+            forget_publication(package_id)
+            cprint("Updated resource {0} for record {1}".format(idx, package_id), 'green')
+    except CKANAPIError as ce:
+        cprint(ce.message, 'yellow')
 
 
 def update_ckan_record(package_dict):
@@ -103,17 +116,13 @@ def update_ckan_record(package_dict):
     :return: The created package
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
     new_package = None
-
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            new_package = ckan_instance.action.package_patch(**package_dict)
-            cprint("Updated record {0}".format(package_dict['id']), 'green')
-        except Exception as ex:
-            cprint("Unable to update existing portal record: {0}".format(ex.message), 'red')
+    try:
+        new_package = ckan.authorized.action.package_patch(**package_dict)
+        forget_publication(package_dict['id'])
+        cprint("Updated record {0}".format(package_dict['id']), 'green')
+    except Exception as ex:
+        cprint("Unable to update existing portal record: {0}".format(ex.message), 'red')
     return new_package
 
 
@@ -138,3 +147,7 @@ with open(sys.argv[1], 'r') as json_file:
         update_resource(pkg_id, f, i)
         i += 1
     cprint('Upload completed', 'green', attrs=['reverse'])
+    cprint(ckan.summary(), 'green')
+ckan.close()
+if publication_ledger:
+    publication_ledger.close()
@@ -1,14 +1,24 @@
 
 import ConfigParser
+import fcntl
 import logging
 import os
 import simplejson as json
+import threading
 import traceback
 # noinspection PyPackageRequirements
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService
 from ckan.lib.munge import munge_filename
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from datetime import datetime
-from lxml import etree
+from obd_archive import ArchiveStore
+from obd_convert import MissingRequiredFieldException, convert, package_validator
+from obd_jsonl import JsonlWriter
+from obd_ledger import IntakeLedger
+from obd_xml import read_xml
 from shutil import copyfile
 
 # Load Azure and file directory configuration information
@@ -30,92 +40,486 @@ fh.setFormatter(formatter)
 logger.addHandler(ch)
 logger.addHandler(fh)
 
-def read_xml(filename):
-    '''
-    Read a GCDocs XML metadata export file, and convert the information to a generic object.
-    :param filename: The path to the XML file to read
-    :return: A python dictionary keyed on the dictionary name
-    '''
+azure_account_name = Config.get('azure-blob-storage', 'account_name')
+azure_account_key = Config.get('azure-blob-storage', 'account_key')
+azure_gcdocs_container = Config.get('azure-blob-storage', 'account_gcdocs_container')
+archive_directory = Config.get('working', 'archive_directory')
+basedir = Config.get('working', 'intake_directory')
+
+# Number of GCDocs exports to download at the same time. The default of 1 processes one blob at a time.
+intake_workers = 1
+if Config.has_option('working', 'intake_workers'):
+    intake_workers = max(1, Config.getint('working', 'intake_workers'))
+
+# Number of processed blobs to collect before they are deleted from the GCDocs container
+delete_batch_size = 100
+if Config.has_option('working', 'delete_batch_size'):
+    delete_batch_size = max(1, Config.getint('working', 'delete_batch_size'))
+
+# Read XML metadata exports into memory instead of parsing them from the downloaded archive copy
+xml_in_memory = False
+if Config.has_option('working', 'xml_in_memory'):
+    xml_in_memory = Config.getboolean('working', 'xml_in_memory')
+# Larger XML exports are downloaded to disk and parsed from there, even with xml_in_memory
+xml_in_memory_max_bytes = 16 * 1024 * 1024
+if Config.has_option('working', 'xml_in_memory_max_bytes'):
+    xml_in_memory_max_bytes = max(0, Config.getint('working', 'xml_in_memory_max_bytes'))
+
+# Convert the XML metadata straight to CKAN JSON lines, instead of writing JSON files for obd_02
+fused_output = False
+if Config.has_option('working', 'fused_output'):
+    fused_output = Config.getboolean('working', 'fused_output')
+
+# Record of the blobs handled so far, so reruns can skip work that was already completed
+ledger = IntakeLedger(':memory:')
+if Config.has_option('working', 'intake_ledger'):
+    ledger = IntakeLedger(Config.get('working', 'intake_ledger'))
+
+# Linux ioctl used to clone a file on copy-on-write file systems such as btrfs and XFS
+FICLONE = 0x40049409
+
+# Azure interface. Each worker thread gets its own service object so HTTP sessions are not shared.
+thread_data = threading.local()
+
+
+def get_blob_service():
+    """
+    Get the Azure blob service for the current thread
+    :return: BlockBlobService
+    """
+    if not hasattr(thread_data, 'blob_service'):
+        thread_data.blob_service = BlockBlobService(azure_account_name, azure_account_key)
+    return thread_data.blob_service
+
+
+def get_gcdoc_name_root(blob_name):
+    """
+    Get the root of a file name exported from GCDOCS
+    :param blob_name: a file name ex. 123.doc or 123.doc.xml
+    :return: File name root
+    """
+    return os.path.basename(blob_name).split('.')[0]
+
+
+class TeeFile(object):
+    """
+    Writable file object that sends everything written to it to two files. The Azure client seeks before
+    writing each range when downloading in parallel, so seek and tell are passed on as well.
+    """
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def write(self, data):
+        self.first.write(data)
+        self.second.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.first.seek(offset, whence)
+        self.second.seek(offset, whence)
+
+    def tell(self):
+        return self.first.tell()
+
+    def flush(self):
+        self.first.flush()
+        self.second.flush()
+
+
+def same_filesystem(first_dir, second_dir):
+    """
+    :return: True if both directories are on the same device, so files can be linked between them
+    """
+    return os.stat(first_dir).st_dev == os.stat(second_dir).st_dev
+
+
+def link_or_copy(source_file, dest_file):
+    """
+    Make an archive copy of a file without reading it back where possible. A hard link is tried first,
+    then a copy-on-write clone, then a regular copy.
+    :param source_file: File to copy
+    :param dest_file: Path of the copy
+    :return: Nothing
+    """
     try:
-        root = etree.parse(filename).getroot()
-    except etree.XMLSyntaxError as xe:
-        logger.error(xe.message)
-        logger.error(traceback.format_exc())
+        os.link(source_file, dest_file)
+        return
+    except OSError:
+        pass
+    try:
+        with open(source_file, 'rb') as src, open(dest_file, 'wb') as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        return
+    except (IOError, OSError):
+        pass
+    copyfile(source_file, dest_file)
+
+
+def archive_file(local_file, name):
+    """
+    Keep an archive copy of a downloaded file
+    :param local_file: Path to the downloaded file
+    :param name: Original file name
+    :return: Nothing
+    """
+    if archive_store:
+        archive_store.add_file(local_file, name)
+    else:
+        link_or_copy(local_file, os.path.join(archive_folder, name))
+
+
+def archive_writer(name):
+    """
+    :param name: Original file name
+    :return: Writable file object for the archive copy of a file
+    """
+    if archive_store:
+        return archive_store.writer(name)
+    return open(os.path.join(archive_folder, name), 'wb')
+
+
+def archive_bytes(data, name):
+    """
+    Keep an archive copy of a file downloaded into memory
+    :param data: File contents
+    :param name: Original file name
+    :return: Path of the archive copy, or None if it was added to the archive store
+    """
+    if archive_store:
+        archive_store.add_bytes(data, name)
         return None
+    archive_path = os.path.join(archive_folder, munge_filename(name))
+    with open(archive_path, 'wb') as archive_copy:
+        archive_copy.write(data)
+    return archive_path
+
+
+def write_intake_json(x_fields, basename, source_name, source):
+    """
+    Save the metadata read from a GCDocs XML export as a JSON file in the intake directory for obd_02.
+    In fused mode, the metadata is converted to a CKAN record instead, and the JSON file is only written
+    if the conversion fails, so the record can be checked and converted again with obd_02.
+    :param x_fields: Dictionary returned by read_xml()
+    :param basename: GCDocs ID of the document
+    :param source_name: GCDocs file name of the document
+    :param source: Tuple of the blob name, ETag and size of the XML export
+    :return: True if a CKAN record was written, the blob is then marked converted by finish_conversions()
+    """
+    if x_fields:
+        x_fields['GCID'] = basename
+        x_fields['GCfile'] = source_name
+        if jsonl_writer and write_ckan_record(x_fields, source):
+            return True
+        # Write to a temporary name first so that obd_02 never picks up a partially written file
+        json_file = os.path.join(basedir, "{0}.json".format(basename))
+        with open(json_file + '.part', 'w') as jsonfile:
+            jsonfile.write(json.dumps(x_fields, indent=4))
+        os.rename(json_file + '.part', json_file)
+    return False
+
 
-    refs, extras = {}, {}
-    assert (root.tag == "enterpriseLibrary")
-    variant = root.find('application').find('parent').find('item').find(
-        'variants').find('variant')
-    start = variant.find('properties')
+def write_ckan_record(fields, source):
+    """
+    Convert GCDocs metadata to a CKAN record and add it to the JSON lines output read by obd_03
+    :param fields: Dictionary returned by read_xml()
+    :param source: Tuple of the blob name, ETag and size of the XML export, handed to finish_conversions()
+    :return: True if the record was written. Records failing validation are not written, obd_02 rejects them.
+    """
+    try:
+        obd_ds = convert(fields, fields['GCfile'])
+        errors = package_validator.validate(obd_ds)
+        if errors:
+            logger.warn('Invalid record for {0}: {1}'.format(fields['GCfile'], '; '.join(errors)))
+            return False
+        json_text = json.dumps(obd_ds)
+    except MissingRequiredFieldException as mx:
+        logger.warn(mx.message)
+        return False
+    except Exception as x:
+        logger.error(fields['GCfile'] + ' ' + x.message)
+        logger.error(traceback.format_exc())
+        return False
+    with jsonl_lock:
+        jsonl_writer.write(json_text, source)
+    return True
 
-    for l in start.findall('property'):
-        if l.find('value').text:
-            refs[l.attrib['name']] = l.find('value').text
-    for c in start.findall('propertyGroup'):
-        assert (c.attrib['name'] == 'customMetadata')
-        for row in c.findall('propertyRow'):
-            r = {}
-            for l in row.findall('property'):
-                r[l.attrib['name']] = l.find('value').text
-            if r['metadata'] and r['attribute']:
-                refs[r['attribute']] = r['metadata']
 
-    return refs
+def finish_conversions(sources):
+    """
+    Mark the XML exports whose CKAN records are in a finished JSON lines shard as converted, and queue them
+    for deletion. obd_03 never reads an unfinished shard, so a blob converted in a run that stops before its
+    shard is finished is converted again by the next run.
+    :param sources: Tuples of the blob name, ETag and size of the XML exports
+    :return: Nothing
+    """
+    for blob_name, etag, size in sources:
+        ledger.set_stage(blob_name, etag, size, 'converted')
+        ledger.queue_delete(blob_name, etag)
 
 
-azure_account_name = Config.get('azure-blob-storage', 'account_name')
-azure_account_key = Config.get('azure-blob-storage', 'account_key')
-azure_gcdocs_container = Config.get('azure-blob-storage', 'account_gcdocs_container')
-archive_directory = Config.get('working', 'archive_directory')
+def count_queued_delete():
+    """
+    Count a blob queued for deletion since the last flush. Blobs left in the queue by failed deletes are not
+    counted again, so they are retried once per batch instead of by a flush after every blob.
+    :return: True once delete_batch_size blobs were queued since the last flush
+    """
+    with flush_count_lock:
+        delete_counts['queued'] += 1
+        if delete_counts['queued'] < delete_batch_size:
+            return False
+        delete_counts['queued'] = 0
+        return True
+
+
+def process_blob(blob):
+    """
+    Download a single GCDocs export file, archive it, and queue it for deletion from the GCDocs container
+    once the local copies have been written. Stages already completed for this version of the blob in an
+    earlier run are skipped.
+    :param blob: Blob from the GCDocs container listing
+    :return: True if the blob was processed successfully
+    """
+    blob_service = get_blob_service()
+    blob_name = blob.name
+    etag = blob.properties.etag
+    size = blob.properties.content_length
+    previous_stage = ledger.get(blob_name, etag)[0]
+    queued_by_shard = False
+
+    # Convert XML files to a simpler JSON files
+    if os.path.splitext(blob_name)[1] == '.xml':
+        source_name = os.path.splitext(os.path.basename(blob_name))[0]
+        basename = os.path.splitext(source_name)[0]
+
+        local_file = ledger.path(blob_name, etag)
+        if ledger.reached(blob_name, etag, 'converted'):
+            ledger.count('parses_skipped')
+        elif xml_in_memory and size <= xml_in_memory_max_bytes:
+            # Parse the metadata straight from memory, while the archive copy is written in the background
+            logger.info('Downloading {0}'.format(os.path.basename(blob_name)))
+            xml_data = blob_service.get_blob_to_bytes(azure_gcdocs_container, blob_name).content
+            archive_future = None
+            if not ledger.reached(blob_name, etag, 'archived'):
+                archive_future = archive_executor.submit(archive_bytes, xml_data, os.path.basename(blob_name))
+            x_fields = read_xml(BytesIO(xml_data))
+            if archive_future:
+                ledger.set_stage(blob_name, etag, size, 'archived', archive_future.result())
+            # The blob must be archived before its record can finish a shard and queue it for deletion
+            queued_by_shard = write_intake_json(x_fields, basename, source_name, (blob_name, etag, size))
+            if not queued_by_shard:
+                ledger.set_stage(blob_name, etag, size, 'converted')
+        else:
+            if ledger.reached(blob_name, etag, 'archived') and local_file and os.path.exists(local_file):
+                ledger.count('downloads_skipped')
+                ledger.count('bytes_skipped', size)
+            else:
+                logger.info('Downloading {0}'.format(os.path.basename(blob_name)))
+                # With the archive store, the XML file is kept in the store's working directory until converted
+                xml_dir = archive_store.temp_dir if archive_store else archive_folder
+                local_file = os.path.join(xml_dir, munge_filename(os.path.basename(blob_name)))
+                assert isinstance(azure_gcdocs_container, str)
+                if not blob_service.get_blob_to_path(azure_gcdocs_container, blob_name, local_file):
+                    return False
+                if archive_store:
+                    archive_store.add_file(local_file, os.path.basename(blob_name))
+                ledger.set_stage(blob_name, etag, size, 'archived', local_file)
+
+            queued_by_shard = write_intake_json(read_xml(local_file), basename, source_name,
+                                                (blob_name, etag, size))
+            if not queued_by_shard:
+                ledger.set_stage(blob_name, etag, size, 'converted')
+            if archive_store:
+                os.remove(local_file)
+
+    # simply download and backup the document files. The deprecated .ind indicator files no longer serve
+    # a purpose and are only deleted.
+    elif os.path.splitext(blob_name)[1] != '.ind':
+        local_file = os.path.join(basedir, munge_filename(os.path.basename(blob_name)))
+        archive_name = os.path.basename(blob_name)
+        if ledger.reached(blob_name, etag, 'archived'):
+            # The intake copy may already have been uploaded and removed by obd_03
+            ledger.count('downloads_skipped')
+            ledger.count('bytes_skipped', size)
+        else:
+            if ledger.reached(blob_name, etag, 'downloaded') and os.path.exists(local_file):
+                ledger.count('downloads_skipped')
+                ledger.count('bytes_skipped', size)
+                archive_file(local_file, archive_name)
+            elif not archive_store and same_filesystem(basedir, archive_folder):
+                if not blob_service.get_blob_to_path(azure_gcdocs_container, blob_name, local_file):
+                    return False
+                ledger.set_stage(blob_name, etag, size, 'downloaded', local_file)
+                archive_file(local_file, archive_name)
+            else:
+                # Write the intake and archive copies from the same download. The archive store hashes the
+                # data as it arrives, so the blob must then be downloaded in order.
+                with open(local_file, 'wb') as intake_copy, archive_writer(archive_name) as archive_copy:
+                    if not blob_service.get_blob_to_stream(azure_gcdocs_container, blob_name,
+                                                           TeeFile(intake_copy, archive_copy),
+                                                           max_connections=1 if archive_store else 2):
+                        raise IOError('Unable to download {0}'.format(blob_name))
+            ledger.set_stage(blob_name, etag, size, 'archived', local_file)
+
+    if previous_stage in ('archived', 'converted'):
+        # The local copies were written in an earlier run, but the blob could not be deleted
+        ledger.count('deletes_retried')
+    if not queued_by_shard:
+        ledger.queue_delete(blob_name, etag)
+    if count_queued_delete():
+        flush_deletes()
+
+    return True
+
+
+def delete_queued_blob(blob_name, etag):
+    """
+    Delete a blob from the GCDocs container, unless it was replaced since it was downloaded
+    :param blob_name: Blob name
+    :param etag: ETag of the blob version that was processed
+    :return: True if the blob no longer needs to be deleted
+    """
+    try:
+        get_blob_service().delete_blob(azure_gcdocs_container, blob_name, if_match=etag)
+    except AzureMissingResourceHttpError:
+        pass
+    except AzureHttpError as ae:
+        if ae.status_code != 412:
+            logger.error('Unable to delete {0}: {1}'.format(blob_name, ae.message))
+            return False
+        # GCDocs uploaded a new version, which will be processed by the next run
+        logger.info('{0} changed since it was downloaded and was not deleted'.format(blob_name))
+    except Exception as ex:
+        logger.error('Unable to delete {0}: {1}'.format(blob_name, ex.message))
+        return False
+    return True
+
+
+def flush_deletes():
+    """
+    Delete the queued blobs from the GCDocs container with concurrent requests. Blobs that could not be
+    deleted stay in the queue and are retried by the next flush.
+    :return: Nothing
+    """
+    # Only one flush at a time. Blobs queued while a flush is running are picked up by the next one.
+    if not flush_lock.acquire(False):
+        return
+    try:
+        queued = ledger.queued_deletes()
+        for (blob_name, etag), deleted in zip(queued, delete_executor.map(lambda q: delete_queued_blob(*q),
+                                                                             queued)):
+            if deleted:
+                ledger.delete_done(blob_name, etag)
+    finally:
+        flush_lock.release()
+
+
+def process_blob_group(blobs):
+    """
+    Process all of the export files for one GCDocs document. The document files are handled before the
+    XML metadata, so the JSON file read by obd_02 only appears once its document is in the intake directory.
+    If a document cannot be downloaded, its XML metadata is left in the container for the next run.
+    :param blobs: Blobs sharing the same GCDocs name root
+    :return: Nothing
+    """
+    documents = [b for b in blobs if os.path.splitext(b.name)[1] not in ('.xml', '.ind')]
+    others = [b for b in blobs if os.path.splitext(b.name)[1] in ('.xml', '.ind')]
+    for blob in documents + others:
+        try:
+            if not process_blob(blob) and blob in documents:
+                logger.warn('Unable to download {0}, skipping its metadata'.format(blob.name))
+                return
+        except Exception:
+            logger.error(traceback.format_exc())
+            if blob in documents:
+                return
+
+
+def blob_groups(generator):
+    """
+    Group the blob listing by GCDocs name root. Azure lists blobs in name order, so the export files for
+    one document are always next to each other.
+    :param generator: Azure blob listing
+    :return: Generator of lists of blobs
+    """
+    group, group_root = [], None
+    for blob in generator:
+        root = get_gcdoc_name_root(blob.name)
+        if group and root != group_root:
+            yield group
+            group = []
+        group_root = root
+        group.append(blob)
+    if group:
+        yield group
 
-# Azure interface
-block_blob_service = BlockBlobService(azure_account_name, azure_account_key)
 
 # Create a local archive directory to hold a copy of the  XML metadata files and documents
 
 timestamp = datetime.utcnow()
 archive_folder = os.path.join(archive_directory, timestamp.strftime("%Y-%m-%d_%H-%M"))
 
+# When an archive store is configured, files are kept once in the store instead of copied into the folder
+archive_store = None
+if Config.has_option('working', 'archive_store'):
+    archive_store = ArchiveStore(Config.get('working', 'archive_store'),
+                                 timestamp.strftime("obd_01_%Y-%m-%d_%H-%M-%S"))
+
+# In fused mode, CKAN records are written straight to the JSON lines output read by obd_03
+jsonl_writer = None
+jsonl_lock = threading.Lock()
+if fused_output:
+    jsonl_max_bytes = 0
+    if Config.has_option('working', 'jsonl_max_bytes'):
+        jsonl_max_bytes = Config.getint('working', 'jsonl_max_bytes')
+    if archive_store:
+        jsonl_archive_writer = archive_store.writer
+    else:
+        jsonl_archive_writer = lambda shard_name: open(os.path.join(archive_directory, shard_name), 'w')
+    jsonl_writer = JsonlWriter(Config.get('working', 'ckanjson_directory'),
+                               timestamp.strftime("ckan_obd_%Y-%m-%d_%H-%M-%S.jsonl"),
+                               max_bytes=jsonl_max_bytes, archive_writer=jsonl_archive_writer,
+                               on_finish=finish_conversions)
+
+# Background writer for the archive copies of XML files read into memory
+archive_executor = ThreadPoolExecutor(max_workers=intake_workers)
+
+# Blobs are deleted from the GCDocs container in batches, once their local copies are written. Deletes left
+# in the queue by an earlier run are retried first.
+delete_executor = ThreadPoolExecutor(max_workers=max(4, intake_workers))
+flush_lock = threading.Lock()
+# Blobs queued since the last flush
+delete_counts = Counter()
+flush_count_lock = threading.Lock()
+flush_deletes()
+
 # Download XML files from Azure and convert to JSON format
-generator = block_blob_service.list_blobs(azure_gcdocs_container)
-basedir = Config.get('working', 'intake_directory')
-for blob in generator:
-    # Don't create an archive directory unless needed
-    if not os.path.exists(archive_folder):
-        os.mkdir(archive_folder, 0o775)
+generator = get_blob_service().list_blobs(azure_gcdocs_container)
+if intake_workers == 1:
+    for blob_group in blob_groups(generator):
+        # Don't create an archive directory unless needed
+        if not archive_store and not os.path.exists(archive_folder):
+            os.mkdir(archive_folder, 0o775)
+        process_blob_group(blob_group)
+else:
+    # Limit the number of queued groups so a large container listing is not held in memory
+    pending = threading.BoundedSemaphore(intake_workers * 2)
+    executor = ThreadPoolExecutor(max_workers=intake_workers)
     try:
-        # Convert XML files to a simpler JSON files
-        if os.path.splitext(blob.name)[1] == '.xml':
-            source_name = os.path.splitext(os.path.basename(blob.name))[0]
-            basename = os.path.splitext(source_name)[0]
-
-            with open(os.path.join(basedir, "{0}.json".format(basename)), 'w') as jsonfile:
-                logger.info('Downloading {0}'.format(os.path.basename(blob.name)))
-                local_file = os.path.join(archive_folder, munge_filename(os.path.basename(blob.name)))
-                assert isinstance(azure_gcdocs_container, str)
-                b = block_blob_service.get_blob_to_path(azure_gcdocs_container, blob.name, local_file)
-                if b:
-                    block_blob_service.delete_blob(azure_gcdocs_container, blob.name)
-                x_fields = read_xml(local_file)
-                if x_fields:
-                    x_fields['GCID'] = basename
-                    x_fields['GCfile'] = source_name
-                    jsonfile.write(json.dumps(x_fields, indent=4))
-
-        # These deprecated indicator files no longer serve a purpose and can be deleted
-        elif os.path.splitext(blob.name)[1] == '.ind':
-            block_blob_service.delete_blob(azure_gcdocs_container, blob.name)
-
-        # simply download and backup the document files
-        else:
-            local_file = os.path.join(basedir, munge_filename(os.path.basename(blob.name)))
-            archive_file = os.path.join(archive_folder, os.path.basename(blob.name))
-            b = block_blob_service.get_blob_to_path(azure_gcdocs_container, blob.name, local_file)
-            if b:
-                block_blob_service.delete_blob(azure_gcdocs_container, blob.name)
-            copyfile(local_file, archive_file)
-
-    except Exception as x:
-        logger.error(traceback.format_exc())
+        for blob_group in blob_groups(generator):
+            if not archive_store and not os.path.exists(archive_folder):
+                os.mkdir(archive_folder, 0o775)
+            pending.acquire()
+            future = executor.submit(process_blob_group, blob_group)
+            future.add_done_callback(lambda f: pending.release())
+    finally:
+        executor.shutdown(wait=True)
+    logger.info('Intake completed with {0} workers'.format(intake_workers))
+archive_executor.shutdown(wait=True)
+if jsonl_writer:
+    jsonl_writer.close()
+flush_deletes()
+delete_executor.shutdown(wait=True)
 
+logger.info(ledger.summary())
+ledger.close()
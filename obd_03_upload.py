@@ -1,20 +1,28 @@
 
 import ConfigParser
-import hashlib
+import functools
 import logging
+import mimetypes
 import os
-import requests.exceptions
 import simplejson as json
+import threading
+import time
 import traceback
+import uuid
 from azure.common import AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService
 from ckan.logic import NotFound
 from ckan.lib.munge import munge_filename
-from ckanapi import RemoteCKAN
 from ckanapi.errors import CKANAPIError
-from datetime import datetime
-from dateutil import parser as dateparser
-from tempfile import mkdtemp
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from obd_blocks import BlobSlots, upload_blocks
+from obd_ckan import CircuitOpen, PortalUnavailable, ckan_client
+from obd_dates import parse_date
+from obd_hash import HashingWriter, hash_file
+from obd_jsonl import JsonlWriter
+from obd_ledger import PublicationLedger, metadata_digest
 # noinspection PyPackageRequirements
 from azure.storage.blob.models import ResourceProperties
 
@@ -25,13 +33,71 @@ Config.read('azure.ini')
 
 ckanjson_dir = Config.get('working', 'ckanjson_directory')
 
-block_blob_service = BlockBlobService(Config.get('azure-blob-storage', 'account_name'),
-                                      Config.get('azure-blob-storage', 'account_key'))
+azure_account_name = Config.get('azure-blob-storage', 'account_name')
+azure_account_key = Config.get('azure-blob-storage', 'account_key')
 
 ckan_container = Config.get('azure-blob-storage', 'account_obd_container')
 gcdocs_container = Config.get('azure-blob-storage', 'account_gcdocs_container')
 doc_intake_dir = Config.get('working', 'intake_directory')
 
+# Number of CKAN records uploaded at the same time. The default of 1 processes the records one at a time.
+upload_workers = 1
+if Config.has_option('working', 'upload_workers'):
+    upload_workers = max(1, Config.getint('working', 'upload_workers'))
+
+# Number of Azure blob storage connections in use at the same time, by default one for each worker. A file
+# upload takes one for each of its blob_upload_connections. The CKAN API calls are limited by
+# ckan_max_concurrency, so many records can wait on the network without overloading either.
+blob_concurrency = upload_workers
+if Config.has_option('azure-blob-storage', 'blob_concurrency'):
+    blob_concurrency = max(1, Config.getint('azure-blob-storage', 'blob_concurrency'))
+blob_slots = BlobSlots(blob_concurrency)
+
+# Number of blocks of a file uploaded to blob storage at the same time
+blob_upload_connections = 4
+if Config.has_option('azure-blob-storage', 'blob_upload_connections'):
+    blob_upload_connections = max(1, Config.getint('azure-blob-storage', 'blob_upload_connections'))
+
+# Resource files of at least this many bytes are uploaded in blocks straight to the OBD container, and then
+# registered in CKAN, instead of being sent through the CKAN API. 0 sends every file through CKAN.
+direct_upload_bytes = 0
+if Config.has_option('azure-blob-storage', 'direct_upload_bytes'):
+    direct_upload_bytes = max(0, Config.getint('azure-blob-storage', 'direct_upload_bytes'))
+
+# CKAN API client shared by all the calls of this run
+ckan = ckan_client(Config, upload_workers)
+
+# SQLite file recording the datasets published to the portal, so they do not have to be looked up in CKAN
+# for every record. Entries are checked against CKAN again after publication_verify_hours.
+publication_verify_hours = 24
+if Config.has_option('working', 'publication_verify_hours'):
+    publication_verify_hours = Config.getfloat('working', 'publication_verify_hours')
+publication_ledger = PublicationLedger(':memory:', timedelta(hours=publication_verify_hours))
+if Config.has_option('working', 'publication_ledger'):
+    publication_ledger = PublicationLedger(Config.get('working', 'publication_ledger'),
+                                           timedelta(hours=publication_verify_hours))
+
+# Number of datasets looked up together with package_search before a JSON lines file is processed.
+# 0 looks up each dataset with package_show.
+prefetch_batch_size = 100
+if Config.has_option('working', 'prefetch_batch_size'):
+    prefetch_batch_size = max(0, Config.getint('working', 'prefetch_batch_size'))
+
+# Number of times a record can fail before it is written to the dead letter file. Failed records are retried
+# by the next run until then. 0 drops failed records.
+max_record_failures = 0
+if Config.has_option('working', 'max_record_failures'):
+    max_record_failures = max(0, Config.getint('working', 'max_record_failures'))
+dead_letter_dir = Config.get('working', 'archive_directory')
+if Config.has_option('working', 'dead_letter_directory'):
+    dead_letter_dir = Config.get('working', 'dead_letter_directory')
+
+# Prefix of the resource file hash recorded in the hash field of the CKAN resources
+HASH_PREFIX = 'sha384:'
+
+# Fields CKAN validates with isodate, which it stores in its own format
+DATE_FIELDS = frozenset(['date_published', 'date_modified', 'date_expires'])
+
 # Setup logging
 
 logger = logging.getLogger('base')
@@ -47,6 +113,20 @@ logger.addHandler(ch)
 logger.addHandler(fh)
 
 
+# Azure interface. Each worker thread gets its own service object so HTTP sessions are not shared.
+thread_data = threading.local()
+
+
+def get_blob_service():
+    """
+    Get the Azure blob service for the current thread
+    :return: BlockBlobService
+    """
+    if not hasattr(thread_data, 'blob_service'):
+        thread_data.blob_service = BlockBlobService(azure_account_name, azure_account_key)
+    return thread_data.blob_service
+
+
 def md5(file_to_hash):
     """
     Get an md5 hash value for a file.
@@ -54,12 +134,9 @@ def md5(file_to_hash):
     :return: md5 hash value or None if the file could not be found
     """
 
-    hash_md5 = hashlib.md5()
-    if os.path.isfile(file_to_hash):
-        with open(file_to_hash, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+    hashes = hash_file(file_to_hash, ('md5',))
+    if hashes:
+        return hashes['md5']
     else:
         logger.warn("md5(): File not found: {0}".format(file_to_hash))
         return None
@@ -72,12 +149,9 @@ def sha384(file_to_hash):
     :return: SHA 384 hash value or None if the file could not be found
     """
 
-    hash_sha = hashlib.sha384()
-    if os.path.isfile(file_to_hash):
-        with open(file_to_hash, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha.update(chunk)
-        return hash_sha.hexdigest()
+    hashes = hash_file(file_to_hash, ('sha384',))
+    if hashes:
+        return hashes['sha384']
     else:
         logger.debug("sha384() File not found: {0}".format(file_to_hash))
         return None
@@ -90,23 +164,20 @@ def get_ckan_record(record_id):
     :return: The CKAN package, or an empty dict if the dataset could not be retrieved
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    user_agent = Config.get('web', 'user_agent')
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent) as ckan_instance:
-        package_record = {}
-        try:
-            package_record = ckan_instance.action.package_show(id=record_id)
+    package_record = {}
+    try:
+        package_record = ckan.anonymous.action.package_show(id=record_id)
 
-        except NotFound:
-            # This is a new record!
-            logger.info('Record {0} does not exist'.format(record_id))
-        except requests.exceptions.ConnectionError as ce:
-            logger.error('get_ckan_record(): Fatal connection error {0}'.format(ce.message))
-            exit(code=500)
-        except CKANAPIError as ne:
-            logger.error('get_ckan_record(): Unexpected error {0}'.format(ne.message))
+    except NotFound:
+        # This is a new record!
+        logger.info('Record {0} does not exist'.format(record_id))
+    except PortalUnavailable:
+        # Retried by the CKAN client already, the record fails
+        raise
+    except CKANAPIError as ne:
+        logger.error('get_ckan_record(): Unexpected error {0}'.format(ne.message))
 
-        return package_record
+    return package_record
 
 
 def add_ckan_record(package_dict):
@@ -116,16 +187,13 @@ def add_ckan_record(package_dict):
     :return: The created package
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
     new_package = None
-
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            new_package = ckan_instance.action.package_create(**package_dict)
-        except Exception as ex:
-            logger.error("Unable to create new portal record: {0}".format(ex.message))
+    try:
+        new_package = ckan.authorized.action.package_create(**package_dict)
+    except PortalUnavailable:
+        raise
+    except Exception as ex:
+        logger.error("Unable to create new portal record: {0}".format(ex.message))
     return new_package
 
 
@@ -136,16 +204,18 @@ def update_ckan_record(package_dict):
     :return: The created package
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
     new_package = None
-
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            new_package = ckan_instance.action.package_patch(**package_dict)
-        except Exception as ex:
-            logger.error("Unable to update existing portal record: {0}".format(ex.message))
+    try:
+        new_package = ckan.authorized.action.package_patch(**package_dict)
+        publication_ledger.record_metadata(package_dict['id'], metadata_digest(package_dict))
+        count_patch('sent')
+    except NotFound:
+        logger.error("Unable to find portal record {0} to update".format(package_dict['id']))
+        publication_ledger.remove(package_dict['id'], stale=True)
+    except PortalUnavailable:
+        raise
+    except Exception as ex:
+        logger.error("Unable to update existing portal record: {0}".format(ex.message))
     return new_package
 
 
@@ -160,63 +230,168 @@ def delete_ckan_record(package_id):
     package_record = get_ckan_record(package_id)
     if len(package_record) == 0:
         logger.warn("Cannot find record {0} to delete".format(package_id))
+        publication_ledger.remove(package_id)
         return
 
-    # Get rid of the resource
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
-
     # Delete the local file if it exists
 
     gcdocs_file = os.path.join(doc_intake_dir, munge_filename(os.path.basename(package_record['resources'][0]['name'])))
     if os.path.exists(gcdocs_file):
         os.remove(gcdocs_file)
 
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            delete_blob(ckan_container, 'resources/{0}/{1}'.format(package_record['resources'][0]['id'],
-                                                                   package_record['resources'][0]['name'].lower()))
-            ckan_instance.action.package_delete(id=package_record['id'])
-            ckan_instance.action.dataset_purge(id=package_record['id'])
-            logger.info("Deleted expired CKAN record {0}".format(package_record['id']))
-        except Exception as ex:
-            logger.error("Unexpected error when deleting record {0}".format(ex.message))
+    # Get rid of the resource
+    try:
+        delete_blob(ckan_container, 'resources/{0}/{1}'.format(package_record['resources'][0]['id'],
+                                                               package_record['resources'][0]['name'].lower()))
+        ckan.authorized.action.package_delete(id=package_record['id'])
+        ckan.authorized.action.dataset_purge(id=package_record['id'])
+        publication_ledger.remove(package_record['id'])
+        logger.info("Deleted expired CKAN record {0}".format(package_record['id']))
+    except PortalUnavailable:
+        raise
+    except Exception as ex:
+        logger.error("Unexpected error when deleting record {0}".format(ex.message))
 
 
-def update_resource(package_id, resource_file):
+def update_resource(package_id, resource_file, resource_sha384, resource_id=None):
     """
-    Add or update the resource file for the dataset
+    Add or update the resource file for the dataset. The SHA 384 hash of the file is recorded in the resource,
+    so later runs can tell if the file changed without downloading it.
     :param package_id: OBD dataset ID
     :param resource_file: path to the resource file
-    :return: Nothing
+    :param resource_sha384: SHA 384 hash value of the resource file
+    :param resource_id: ID of the existing resource, if known. Otherwise it is looked up in CKAN.
+    :return: The CKAN resource, or None if it could not be updated
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
+    if resource_id is None:
         try:
-            package_record = ckan_instance.action.package_show(id=package_id)
+            package_record = ckan.authorized.action.package_show(id=package_id)
         except NotFound as nf:
             logger.error("Unable to find record {0} to update".format(nf.message))
-            return
+            return None
+        if len(package_record['resources']) > 0:
+            resource_id = package_record['resources'][0]['id']
 
-        try:
-            if len(package_record['resources']) == 0:
-                ckan_instance.action.resource_create(package_id=package_id,
-                                                     url='',
-                                                     upload=open(resource_file, 'rb'))
-                logger.info("Added new resource to {0}".format(package_id))
-            else:
-                ckan_instance.action.resource_patch(id=package_record['resources'][0]['id'],
-                                                    url='',
-                                                    upload=open(resource_file, 'rb'))
-        except CKANAPIError as ce:
-            logger.error("Unexpected error when updating a record {0}: ".format(ce.message))
-            logger.error(traceback.format_exc())
+    if direct_upload_bytes and os.path.getsize(resource_file) >= direct_upload_bytes:
+        return upload_resource_blocks(package_id, resource_file, resource_sha384, resource_id)
 
-        logger.info("Updated resource {0}".format(package_record['resources'][0]['id']))
+    try:
+        if resource_id is None:
+            resource = ckan.authorized.action.resource_create(package_id=package_id,
+                                                              url='',
+                                                              hash=resource_hash(resource_sha384),
+                                                              upload=open(resource_file, 'rb'))
+            logger.info("Added new resource to {0}".format(package_id))
+        else:
+            resource = ckan.authorized.action.resource_patch(id=resource_id,
+                                                             url='',
+                                                             hash=resource_hash(resource_sha384),
+                                                             upload=open(resource_file, 'rb'))
+        publication_ledger.record_resource(package_id, resource)
+        logger.info("Updated resource {0}".format(resource['id']))
+        return resource
+    except NotFound:
+        # The resource recorded in the publication ledger is no longer on the portal
+        logger.error("Unable to find resource {0} of record {1}".format(resource_id, package_id))
+        publication_ledger.remove(package_id, stale=True)
+    except PortalUnavailable:
+        raise
+    except CKANAPIError as ce:
+        logger.error("Unexpected error when updating a record {0}: ".format(ce.message))
+        logger.error(traceback.format_exc())
+    return None
+
+
+def upload_resource_blocks(package_id, resource_file, resource_sha384, resource_id=None):
+    """
+    Upload a large resource file in blocks straight to the OBD container, where CKAN serves its uploads from, and
+    register it in CKAN once the blob is committed. A failed upload leaves its blocks staged in blob storage,
+    and the next attempt only sends the missing ones.
+    :param package_id: OBD dataset ID
+    :param resource_file: path to the resource file
+    :param resource_sha384: SHA 384 hash value of the resource file
+    :param resource_id: ID of the existing resource, or None to add one
+    :return: The CKAN resource, or None if it could not be updated
+    """
+    file_name = munge_filename(os.path.basename(resource_file))
+    new_resource = resource_id is None
+    if new_resource:
+        # The same ID is used by every attempt, so a failed upload is resumed into the same blob
+        resource_id = str(uuid.uuid5(uuid.NAMESPACE_URL, 'obd-resource/{0}/{1}'.format(package_id, file_name)))
+    blob_name = 'resources/{0}/{1}'.format(resource_id, file_name)
+    mimetype = mimetypes.guess_type(file_name)[0]
+    try:
+        blocks_sent, blocks_reused = upload_blocks(get_blob_service, ckan_container, blob_name, resource_file,
+                                                   blob_upload_connections, blob_slots, mimetype)
+    except Exception as ex:
+        logger.error("Unable to upload {0} to Azure, the next attempt resumes it: {1}".format(blob_name, ex.message))
+        return None
+    logger.info("Uploaded {0}: {1} blocks sent, {2} already stored".format(blob_name, blocks_sent, blocks_reused))
+
+    resource_fields = {'url': file_name,
+                       'url_type': 'upload',
+                       'hash': resource_hash(resource_sha384),
+                       'size': os.path.getsize(resource_file),
+                       'mimetype': mimetype,
+                       'last_modified': datetime.utcnow().isoformat()}
+    try:
+        if new_resource:
+            resource = ckan.authorized.action.resource_create(package_id=package_id, id=resource_id,
+                                                              name=file_name, **resource_fields)
+            logger.info("Added new resource to {0}".format(package_id))
+        else:
+            resource = ckan.authorized.action.resource_patch(id=resource_id, **resource_fields)
+        publication_ledger.record_resource(package_id, resource)
+        logger.info("Updated resource {0}".format(resource['id']))
+        return resource
+    except NotFound:
+        logger.error("Unable to find resource {0} of record {1}".format(resource_id, package_id))
+        publication_ledger.remove(package_id, stale=True)
+    except PortalUnavailable:
+        raise
+    except CKANAPIError as ce:
+        logger.error("Unable to register resource {0} in CKAN: {1}".format(blob_name, ce.message))
+    return None
+
+
+def resource_hash(resource_sha384):
+    """
+    :param resource_sha384: SHA 384 hash value of a resource file, or None
+    :return: Value of the hash field of the CKAN resource
+    """
+    if not resource_sha384:
+        return ''
+    return HASH_PREFIX + resource_sha384
+
+
+def stored_sha384(resource):
+    """
+    Get the SHA 384 hash recorded in a CKAN resource when its file was uploaded
+    :param resource: CKAN resource
+    :return: SHA 384 hash value, or None if no hash was recorded
+    """
+    stored_hash = resource.get('hash') or ''
+    if stored_hash.startswith(HASH_PREFIX):
+        return stored_hash[len(HASH_PREFIX):]
+    return None
+
+
+def record_resource_hash(package_id, resource_id, resource_sha384):
+    """
+    Record the SHA 384 hash of the file of an existing resource
+    :param package_id: OBD dataset ID
+    :param resource_id: CKAN resource ID
+    :param resource_sha384: SHA 384 hash value of the resource file
+    :return: Nothing
+    """
+    try:
+        resource = ckan.authorized.action.resource_patch(id=resource_id, hash=resource_hash(resource_sha384))
+        publication_ledger.record_resource(package_id, resource)
+    except PortalUnavailable:
+        raise
+    except CKANAPIError as ce:
+        logger.error("Unable to record the hash of resource {0}: {1}".format(resource_id, ce.message))
 
 
 def get_blob(container, blob_name, local_name):
@@ -229,9 +404,10 @@ def get_blob(container, blob_name, local_name):
     """
     blob = None
     try:
-        blob = block_blob_service.get_blob_to_path(container, blob_name, local_name)
+        with blob_slots:
+            blob = get_blob_service().get_blob_to_path(container, blob_name, local_name)
     except AzureMissingResourceHttpError as amrh_ex:
-        logger.debug('No such Azure resource: {0}'.format(obd_resource_name))
+        logger.debug('No such Azure resource: {0}'.format(blob_name))
         logger.debug("get_blob(): ".format(amrh_ex.message))
     except Exception as ex:
         logger.error("Unexpected error when retrieving a resource from Azure: ".format(ex.message))
@@ -239,6 +415,26 @@ def get_blob(container, blob_name, local_name):
     return blob
 
 
+def get_blob_sha384(container, blob_name):
+    """
+    Get the SHA 384 hash value of a file in Azure blob storage, hashing it as it is downloaded
+    :param container: Azure Blob Storage container name
+    :param blob_name: Azure Blob file name
+    :return: SHA 384 hash value or None if the blob could not be read
+    """
+    hashing_writer = HashingWriter(('sha384',))
+    try:
+        with blob_slots:
+            get_blob_service().get_blob_to_stream(container, blob_name, hashing_writer, max_connections=1)
+    except AzureMissingResourceHttpError:
+        logger.debug('No such Azure resource: {0}'.format(blob_name))
+        return None
+    except Exception as ex:
+        logger.error("Unexpected error when retrieving a resource from Azure: {0}".format(ex.message))
+        return None
+    return hashing_writer.hexdigests()['sha384']
+
+
 def put_blob(container, blob_name, local_name):
     """
     Upload a file to Azure blob storage
@@ -250,9 +446,15 @@ def put_blob(container, blob_name, local_name):
     """
     success = False
     try:
-        block_blob_service.create_blob_from_path(container, blob_name, local_name, max_connections=4)
+        connections = blob_slots.acquire(blob_upload_connections)
+        try:
+            get_blob_service().create_blob_from_path(container, blob_name, local_name,
+                                                     max_connections=connections)
+        finally:
+            blob_slots.release(connections)
         # Verify
-        success = block_blob_service.exists(container, blob_name=blob_name)
+        with blob_slots:
+            success = get_blob_service().exists(container, blob_name=blob_name)
     except Exception as ex:
         logger.error("Unexpected error when saving a resource to Azure: ".format(ex.message))
         logger.debug("put_blob(): ".format(ex.message))
@@ -267,7 +469,8 @@ def delete_blob(container, blob_name):
     :return: Nothing
     """
     try:
-        block_blob_service.delete_blob(container, blob_name)
+        with blob_slots:
+            get_blob_service().delete_blob(container, blob_name)
     except Exception as ex:
         logger.error("Unexpected error when deleting a resource from Azure: ".format(ex.message))
         logger.debug("delete_blob(): ".format(ex.message))
@@ -286,138 +489,491 @@ def get_gcdoc_name_root(blob_name):
         return None
 
 
-# Set up for interacting with Azure
-download_ckan_dir = mkdtemp()
+# Outcome of processing a CKAN record
+RECORD_UPDATED = 'updated'
+RECORD_UNCHANGED = 'unchanged'
+RECORD_EXPIRED = 'expired'
+RECORD_SKIPPED = 'skipped'
+RECORD_FAILED = 'failed'
+# The rest of the JSON lines file is not processed
+RECORD_ABORT = 'aborted'
 
-# initialize working variables
-jsonl_file_list = []
-this_moment = datetime.utcnow()
 
-# Get a list of JSON line files to process
-for root, dirs, files in os.walk(ckanjson_dir):
-    for json_file in files:
-        if json_file.endswith(".jsonl"):
-            jsonl_file_list.append((os.path.join(root, json_file)))
-if len(jsonl_file_list) < 1:
-    logger.debug("Nothing to import.")
-    exit(0)
+def process_record(obd_record):
+    """
+    Add, update or remove the portal dataset and resource for one CKAN record. Errors are logged, and only
+    affect this record.
+    :param obd_record: CKAN record from a JSON lines file written by obd_02
+    :return: Outcome of the record: RECORD_UPDATED if the resource file was uploaded, RECORD_UNCHANGED,
+             RECORD_EXPIRED, RECORD_SKIPPED, RECORD_FAILED or RECORD_ABORT
+    """
+    try:
+        obd_record_key = get_gcdoc_name_root(obd_record['resources'][0]['name_translated']['en'])  # type: str
+
+        # Verification check - do not post documents that have already expired. Remove it from the portal
+        # if it was uploaded before.
+        expiry_date = parse_date(obd_record['date_expires'])
+        if expiry_date <= datetime.utcnow():
+            logger.warn('This record has already expired')
+
+            # If the dataset exists, then delete the resource and the dataset.
+            delete_ckan_record(obd_record['id'])
+            return RECORD_EXPIRED
+
+        # Get the current published file from the OBD Portal. It may not exist if this is the first
+        # time the document has been posted to the portal. Recently verified datasets are read from the
+        # publication ledger instead.
+
+        # Full portal record, when one was fetched, to compare the metadata with
+        portal_record = prefetched_packages.get(obd_record['id'])
+        ckan_record = publication_ledger.lookup(obd_record['id'])
+        if ckan_record is None:
+            if obd_record['id'] in missing_packages:
+                # The prefetch did not find the dataset, so it is added without looking it up first. If it
+                # was not indexed yet and already exists, it is looked up after all.
+                ckan_record = add_ckan_record(obd_record)
+                if not ckan_record:
+                    ckan_record = get_ckan_record(obd_record['id'])
+            else:
+                ckan_record = get_ckan_record(obd_record['id'])
 
-# Process all Json lines input files
-for ckan_input in jsonl_file_list:
+                # If the record does not exist, then add the document to the OBD Portal. This new record will
+                # have a placeholder resource record.
+                if ckan_record is None or len(ckan_record) == 0:
+                    ckan_record = add_ckan_record(obd_record)
+            if ckan_record:
+                publication_ledger.record_package(ckan_record)
+                portal_record = ckan_record
+
+        # If this record has more than one resource, it cannot be an Open by Default record
+
+        num_of_resources = 0
+        if 'resources' in ckan_record:
+            num_of_resources = len(ckan_record['resources'])
+
+        if num_of_resources > 1:
+            print('More than one resource found for dataset: {0}'.format(ckan_record['id']))
+            return RECORD_SKIPPED
+
+        local_gcdocs_file = os.path.join(doc_intake_dir,
+                                         munge_filename(os.path.basename(ckan_record['resources'][0]['name'])))
+        # Set the file size in the CKAN record
+        if os.path.exists(local_gcdocs_file):
+            ckan_record['resources'][0]['size'] = str(os.path.getsize(local_gcdocs_file) / 1024)
+
+        outcome = RECORD_UPDATED
+        # Check if the resource already exists or not. If it does, download a copy and compare with the
+        # currently uploaded file. If they are the same, no further action is required. If not, then update.
+        if num_of_resources == 1:
+            # Hash the uploaded file on the hashing threads, while the published file is checked
+            gcdocs_sha_future = hash_executor.submit(sha384, local_gcdocs_file)
+
+            # Compare with the hash recorded when the resource was uploaded. Resources uploaded before the
+            # hash was recorded are downloaded and hashed once, and then their hash is recorded.
+            ckan_sha = stored_sha384(ckan_record['resources'][0])
+            hash_recorded = ckan_sha is not None
+            if not hash_recorded:
+                obd_resource_name = 'resources/{0}/{1}'.format(ckan_record['resources'][0]['id'],
+                                                               munge_filename(ckan_record['resources'][0]['name']))
+                # The published file is hashed as it is downloaded, without saving it. If it cannot be read or
+                # hashed, it is treated as changed and uploaded again.
+                ckan_sha = get_blob_sha384(ckan_container, obd_resource_name) or ''
+
+            gcdocs_sha = gcdocs_sha_future.result()
+            if not gcdocs_sha:
+                logger.error('Unable to generate SHA 348 Hash for file {0}'.format(local_gcdocs_file))
+                # Usually the GCDocs file is missing or unreadable. Only this record fails, the others are still
+                # processed.
+                return RECORD_FAILED
+            if not hash_recorded and ckan_sha == gcdocs_sha:
+                record_resource_hash(obd_record['id'], ckan_record['resources'][0]['id'], ckan_sha)
+
+            if ckan_sha == gcdocs_sha:
+                logger.info("No update required for {0}".format(obd_record['id']))
+                outcome = RECORD_UNCHANGED
+
+            else:
+                logger.info("Update required for file {0}".format(obd_record['id']))
+                # Upload file
+                if not update_resource(obd_record['id'], local_gcdocs_file, gcdocs_sha,
+                                       ckan_record['resources'][0]['id']):
+                    outcome = RECORD_FAILED
+
+        elif not update_resource(obd_record['id'], local_gcdocs_file, sha384(local_gcdocs_file)):
+            outcome = RECORD_FAILED
+
+        del obd_record['resources']
+        if metadata_changed(obd_record, portal_record):
+            if update_ckan_record(obd_record) is None:
+                outcome = RECORD_FAILED
+        else:
+            logger.info("No metadata update required for {0}".format(obd_record['id']))
+            count_patch('skipped')
+
+        # A failed record is retried by a later run, which needs the local file to upload it again, or to resume
+        # the upload from the blocks already stored
+        if outcome != RECORD_FAILED and os.path.exists(local_gcdocs_file):
+            os.remove(local_gcdocs_file)
+        return outcome
+    except CircuitOpen as co:
+        # The portal keeps failing. Stop, and resume the file from this record in a later run.
+        logger.error('Record {0} not processed: {1}'.format(obd_record.get('id'), co.message))
+        return RECORD_ABORT
+    except PortalUnavailable as pu:
+        logger.error('Record {0} failed: {1}'.format(obd_record.get('id'), pu.message))
+        return RECORD_FAILED
+    except Exception as x:
+        logger.error(x.message)
+        logger.error(traceback.format_exc())
+        return RECORD_FAILED
+
+
+def metadata_changed(obd_record, portal_record):
+    """
+    Check if the metadata of a record differs from the portal. The fields of the record are compared with the
+    portal record when one was fetched, otherwise its digest is compared with the digest of the metadata last
+    written, from the publication ledger.
+    :param obd_record: CKAN record, without its resources
+    :param portal_record: Package returned by CKAN, or None
+    :return: True if the metadata needs to be written
+    """
+    digest = metadata_digest(obd_record)
+    if portal_record is None:
+        return publication_ledger.digest(obd_record['id']) != digest
+    for field_name, value in obd_record.items():
+        if not same_value(field_name, value, portal_record.get(field_name)):
+            return True
+    publication_ledger.record_metadata(obd_record['id'], digest)
+    return False
+
+
+def same_value(field_name, value, portal_value):
+    """
+    Compare a field of a record with the portal. CKAN stores isodate fields as YYYY-MM-DDTHH:MM:SS, while the
+    conversion writes them as YYYY-MM-DD HH:MM:SS or as they were given in GCDocs, so dates are compared parsed.
+    :param field_name: Field name
+    :param value: Value of the converted record
+    :param portal_value: Value returned by CKAN
+    :return: True if the values are the same
+    """
+    if value == portal_value:
+        return True
+    if field_name not in DATE_FIELDS or not value or not portal_value:
+        return False
+    try:
+        return parse_date(value).replace(tzinfo=None) == parse_date(portal_value).replace(tzinfo=None)
+    except (ValueError, TypeError, OverflowError, AttributeError):
+        return False
+
+
+def prefetch_packages(ckan_input):
+    """
+    Look up the datasets of a JSON lines file in CKAN with a few large package_search queries. The datasets
+    found are recorded in the publication ledger, so the records can be processed without a package_show.
+    Expired records and datasets already verified in the ledger are not looked up.
+    :param ckan_input: Path of the JSON lines file
+    :return: Tuple of the datasets found by ID, and the set of the IDs of the datasets that were not found
+    """
+    record_ids = []
+    right_now = datetime.utcnow()
     with open(ckan_input, 'r') as jl_file:
         for jl_line in jl_file:
             try:
                 obd_record = json.loads(jl_line)
+                if parse_date(obd_record['date_expires']) <= right_now:
+                    continue
+            except Exception:
+                # The record is reported when it is processed
+                continue
+            if not publication_ledger.is_current(obd_record['id']):
+                record_ids.append(obd_record['id'])
+
+    found = {}
+    missing = set()
+    queries = 0
+    for i in range(0, len(record_ids), prefetch_batch_size):
+        batch = record_ids[i:i + prefetch_batch_size]
+        try:
+            result = ckan.authorized.action.package_search(fq='id:({0})'.format(' OR '.join(batch)),
+                                                           rows=len(batch), include_private=True)
+        except Exception as ex:
+            logger.warn('Unable to prefetch datasets from CKAN: {0}'.format(ex.message))
+            continue
+        queries += 1
+        for package_record in result['results']:
+            publication_ledger.record_package(package_record)
+            found[package_record['id']] = package_record
+        missing.update(record_id for record_id in batch if record_id not in found)
+    if record_ids:
+        logger.info('Prefetched {0} datasets with {1} package_search queries, {2} not found'.format(
+            len(record_ids), queries, len(missing)))
+    return found, missing
 
-                obd_record_key = get_gcdoc_name_root(obd_record['resources'][0]['name_translated']['en'])  # type: str
-
-                # Verification check - do not post documents that have already expired. Remove it from the portal
-                # if it was uploaded before.
-                expiry_date = dateparser.parse(obd_record['date_expires'])
-                if expiry_date <= datetime.utcnow():
-                    logger.warn('This record has already expired')
 
-                    # If the dataset exists, then delete the resource and the dataset.
-                    delete_ckan_record(obd_record['id'])
-                    continue
+def count_outcome(outcome):
+    with counts_lock:
+        record_counts[outcome] += 1
 
-                # Get the current published file from the OBD Portal. It may not exist if this is the first
-                # time the document has been posted to the portal
 
-                ckan_record = get_ckan_record(obd_record['id'])
+def count_patch(result):
+    with counts_lock:
+        patch_counts[result] += 1
 
-                # If the record does not exist, then add the document to the OBD Portal. This new record will have
-                # a placeholder resource record.
-                if ckan_record is None or len(ckan_record) == 0:
-                    ckan_record = add_ckan_record(obd_record)
 
-                # If this record has more than one resource, it cannot be an Open by Default record
+def process_jsonl_file(ckan_input, executor):
+    """
+    Process the records of a JSON lines file. With an executor, records are processed in parallel, except that
+    records for the same dataset are processed one after the other in the order of the file.
+    The offset of the first unfinished record is saved in the publication ledger as records finish, so a run
+    that is stopped resumes from there. Failed records are set aside for a later run when max_record_failures
+    is set.
+    :param ckan_input: Path of the JSON lines file
+    :param executor: ThreadPoolExecutor, or None to process the records in this thread
+    :return: True if every record of the file was processed, False if processing stopped early
+    """
+    in_flight = {}
+    in_flight_lock = threading.Lock()
+    aborted = threading.Event()
+    # Fatal errors, such as the exit on a CKAN connection error, raised again in this thread
+    fatal_errors = []
+    # Limit the number of queued records so a large file is not held in memory
+    pending = threading.BoundedSemaphore(upload_workers * 2)
+    # Number of submitted records whose completion has not been recorded yet
+    outstanding = [0]
+    all_done = threading.Condition()
+
+    file_name = os.path.basename(ckan_input)
+    file_size = os.path.getsize(ckan_input)
+    start_offset, last_record_id = publication_ledger.checkpoint(file_name, file_size)
+    if start_offset:
+        logger.info('Resuming {0} after record {1}'.format(file_name, last_record_id))
+    # Offset before which every record is finished, and the records finished after it, by offset
+    checkpoint = [start_offset]
+    finished = {}
+    checkpoint_lock = threading.Lock()
+
+    def record_finished(offset, end_offset, record_id, jl_line, outcome):
+        if outcome == RECORD_ABORT:
+            # The record is processed again when the file is resumed
+            aborted.set()
+            return
+        if outcome == RECORD_FAILED and max_record_failures:
+            set_aside_record(record_id, jl_line)
+        elif record_id and max_record_failures:
+            publication_ledger.clear_failures(record_id)
+        with checkpoint_lock:
+            finished[offset] = (end_offset, record_id)
+            advanced = False
+            while checkpoint[0] in finished:
+                checkpoint[0], checkpoint_record_id = finished.pop(checkpoint[0])
+                advanced = True
+            if advanced:
+                publication_ledger.set_checkpoint(file_name, file_size, checkpoint[0], checkpoint_record_id)
+
+    def record_done(offset, end_offset, record_id, jl_line, future):
+        with in_flight_lock:
+            if in_flight.get(record_id) is future:
+                del in_flight[record_id]
+        try:
+            outcome = future.result()
+        except BaseException as ex:
+            fatal_errors.append(ex)
+            outcome = RECORD_ABORT
+        count_outcome(outcome)
+        record_finished(offset, end_offset, record_id, jl_line, outcome)
+        pending.release()
+        with all_done:
+            outstanding[0] -= 1
+            all_done.notify_all()
 
-                num_of_resources = 0
-                if 'resources' in ckan_record:
-                    num_of_resources = len(ckan_record['resources'])
+    try:
+        with open(ckan_input, 'r') as jl_file:
+            jl_file.seek(start_offset)
+            end_offset = start_offset
+            for jl_line in iter(jl_file.readline, ''):
+                offset = end_offset
+                end_offset += len(jl_line)
+                if aborted.is_set():
+                    break
+                try:
+                    obd_record = json.loads(jl_line)
+                    record_id = obd_record['id']
+                except Exception as x:
+                    logger.error('Unable to read record from {0}: {1}'.format(ckan_input, x.message))
+                    count_outcome(RECORD_FAILED)
+                    record_finished(offset, end_offset, None, jl_line, RECORD_FAILED)
+                    continue
 
-                if num_of_resources > 1:
-                    print('More than one resource found for dataset: {0}'.format(ckan_record['id']))
+                if executor is None:
+                    outcome = process_record(obd_record)
+                    count_outcome(outcome)
+                    record_finished(offset, end_offset, record_id, jl_line, outcome)
+                    if outcome == RECORD_ABORT:
+                        break
                     continue
 
-                local_gcdocs_file = os.path.join(doc_intake_dir,
-                                                 munge_filename(os.path.basename(ckan_record['resources'][0]['name'])))
-                # Set the file size in the CKAN record
-                if os.path.exists(local_gcdocs_file):
-                    ckan_record['resources'][0]['size'] = str(os.path.getsize(local_gcdocs_file) / 1024)
-
-                # Check if the resource already exists or not. If it does, download a copy and compare with the
-                # currently uploaded file. If they are the same, no further action is required. If not, then update.
-                if num_of_resources == 1:
-                    obd_resource_name = 'resources/{0}/{1}'.format(ckan_record['resources'][0]['id'],
-                                                                   munge_filename(ckan_record['resources'][0]['name']))
-
-                    local_ckan_file = os.path.join(download_ckan_dir,
-                                                   os.path.basename(ckan_record['resources'][0]['name']))
-                    # Ensure we can retrieve the resource
-                    if not get_blob(ckan_container, obd_resource_name, local_ckan_file):
-                        # The Azure API may create blank files
-                        if os.path.exists(local_ckan_file):
-                            os.remove(local_ckan_file)
-                        local_ckan_file = None
-
-                    if local_ckan_file:
-                        ckan_sha = sha384(local_ckan_file)
-                        if not ckan_sha:
-                            logger.error('Unable to generate SHA 348 Hash for file {0}'.format(local_ckan_file))
-                            # If this is happening, best to quit and investigate
-                            break
-                    else:
-                        ckan_sha = ''
-
-                    # Get the uploaded file and hash it
-
-                    gcdocs_sha = sha384(local_gcdocs_file)
-                    if not gcdocs_sha:
-                        logger.error('Unable to generate SHA 348 Hash for file {0}'.format(local_gcdocs_file))
-                        # If this is happening, best to quit and investigate
-                        continue
-
-                    if ckan_sha == gcdocs_sha:
-                        logger.info("No update required for {0}".format(obd_record['id']))
-
-                    else:
-                        logger.info("Update required for file {0}".format(obd_record['id']))
-                        # Upload file
-                        update_resource(obd_record['id'], local_gcdocs_file)
-
-                    if local_ckan_file:
-                        os.remove(local_ckan_file)
-
-                else:
-                    update_resource(obd_record['id'], local_gcdocs_file)
-
-                del obd_record['resources']
-                update_ckan_record(obd_record)
-
-                if os.path.exists(local_gcdocs_file):
-                    os.remove(local_gcdocs_file)
-            except Exception as x:
-                logger.error(x.message)
+                with in_flight_lock:
+                    previous = in_flight.get(record_id)
+                if previous is not None:
+                    wait([previous])
+                pending.acquire()
+                with all_done:
+                    outstanding[0] += 1
+                future = executor.submit(process_record, obd_record)
+                with in_flight_lock:
+                    in_flight[record_id] = future
+                future.add_done_callback(functools.partial(record_done, offset, end_offset, record_id, jl_line))
+    finally:
+        # Finish the records of this file before it is removed. The futures are done before their callbacks
+        # have recorded the checkpoint, so wait for the callbacks.
+        with all_done:
+            while outstanding[0]:
+                all_done.wait()
+    if fatal_errors:
+        raise fatal_errors[0]
+    if aborted.is_set():
+        return False
+    publication_ledger.clear_checkpoint(file_name)
+    return True
+
+
+def set_aside_record(record_id, jl_line):
+    """
+    Write a failed record to the retry file read by the next run or, once it has failed max_record_failures
+    times, to the dead letter file
+    :param record_id: CKAN package ID of the record, or None if the line could not be read
+    :param jl_line: JSON line of the record
+    :return: Nothing
+    """
+    failures = publication_ledger.record_failure(record_id) if record_id else max_record_failures
+    with set_aside_lock:
+        if failures >= max_record_failures:
+            logger.error('Record {0} failed {1} times, it is written to the dead letter file'.format(record_id,
+                                                                                                     failures))
+            dead_letter_writer.write(jl_line.rstrip('\n'))
+            dead_letter_writer.sync()
+        else:
+            retry_writer.write(jl_line.rstrip('\n'))
+            retry_writer.sync()
+            # Keep the GCDocs document for the retry
+            document = record_document(jl_line)
+            if document:
+                retained_documents.add(document)
+    if failures >= max_record_failures and record_id:
+        publication_ledger.clear_failures(record_id)
+
+
+def record_document(jl_line):
+    """
+    :param jl_line: JSON line of a record
+    :return: File name of the GCDocs document of the record in the intake directory, or None if the line
+             could not be read
+    """
+    try:
+        document_name = json.loads(jl_line)['resources'][0]['name_translated']['en']
+        return munge_filename(os.path.basename(document_name))
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def remove_record_documents(ckan_input):
+    """
+    Remove the GCDocs documents left in the intake directory by the records of a processed JSON lines file,
+    such as those of expired or skipped records. Only the documents of its records are removed: obd_01 and
+    obd_02 may still be writing documents and intake files for shards that are not finished yet.
+    :param ckan_input: Path of the JSON lines file
+    :return: Nothing
+    """
+    with open(ckan_input, 'r') as jl_file:
+        for jl_line in jl_file:
+            document = record_document(jl_line)
+            if not document or document in retained_documents:
+                continue
+            doc_fn = os.path.join(doc_intake_dir, document)
+            try:
+                if os.path.isfile(doc_fn):
+                    logger.debug("Deleting file " + doc_fn)
+                    os.remove(doc_fn)
+            except Exception as e:
+                logger.error(e.message)
                 logger.error(traceback.format_exc())
 
-    # Save a copy of the JSON line file for audit purposes
-    todays_date = this_moment.strftime("%Y-%m-%d")
-    todays_time = this_moment.strftime("%H-%M")
-    ckan_line_base = os.path.basename(ckan_input)
-    ckan_line_archive = os.path.join(todays_date, todays_time, ckan_line_base)
-    os.remove(ckan_input)
-
-os.rmdir(download_ckan_dir)
-# Get rid of any leftovers
-for doc in os.listdir(doc_intake_dir):
-    doc_fn = os.path.join(doc_intake_dir, doc)
-    try:
-        if os.path.isfile(doc_fn):
-            logger.debug("Deleting file " + doc_fn)
-            os.remove(doc_fn)
-    except Exception as e:
-        logger.error(e.message)
-        logger.error(traceback.format_exc())
+
+# Threads hashing the GCDocs files while the records wait on the portal. Hashing uses the CPU, so a large
+# number of workers does not add hashing threads.
+hash_executor = ThreadPoolExecutor(max_workers=max(2, min(upload_workers, 8)))
+
+# initialize working variables
+jsonl_file_list = []
+this_moment = datetime.utcnow()
+
+# Finish the retry and dead letter files left by a run that was stopped. Their records were synced to disk.
+for set_aside_dir, prefix in [(ckanjson_dir, 'ckan_obd_retry_'), (dead_letter_dir, 'dead_letter_')]:
+    if not os.path.isdir(set_aside_dir):
+        continue
+    for part_file in os.listdir(set_aside_dir):
+        if part_file.startswith(prefix) and part_file.endswith('.jsonl.part'):
+            os.rename(os.path.join(set_aside_dir, part_file), os.path.join(set_aside_dir, part_file[:-len('.part')]))
+
+# Get a list of JSON line files to process
+for root, dirs, files in os.walk(ckanjson_dir):
+    for json_file in files:
+        if json_file.endswith(".jsonl"):
+            jsonl_file_list.append((os.path.join(root, json_file)))
+if len(jsonl_file_list) < 1:
+    logger.debug("Nothing to import.")
+    exit(0)
+
+# Process all Json lines input files
+record_counts = Counter()
+counts_lock = threading.Lock()
+start_time = time.time()
+record_executor = None
+# Datasets of the current file that the prefetch found, and did not find, in CKAN
+prefetched_packages = {}
+missing_packages = set()
+# Metadata patches sent and skipped because nothing changed
+patch_counts = Counter()
+# Failed records are written to a file in the JSON lines directory that the next run picks up, and to the dead
+# letter file once they have failed too many times
+set_aside_lock = threading.Lock()
+retained_documents = set()
+retry_writer = JsonlWriter(ckanjson_dir, this_moment.strftime("ckan_obd_retry_%Y-%m-%d_%H-%M-%S.jsonl"))
+dead_letter_writer = JsonlWriter(dead_letter_dir, this_moment.strftime("dead_letter_%Y-%m-%d_%H-%M-%S.jsonl"))
+if upload_workers > 1:
+    record_executor = ThreadPoolExecutor(max_workers=upload_workers)
+try:
+    for ckan_input in jsonl_file_list:
+        if prefetch_batch_size:
+            prefetched_packages, missing_packages = prefetch_packages(ckan_input)
+        if not process_jsonl_file(ckan_input, record_executor):
+            # Keep the file and its documents, the next run resumes it from its checkpoint
+            logger.error('Stopped processing {0}'.format(ckan_input))
+            continue
+        remove_record_documents(ckan_input)
+
+        # Save a copy of the JSON line file for audit purposes
+        todays_date = this_moment.strftime("%Y-%m-%d")
+        todays_time = this_moment.strftime("%H-%M")
+        ckan_line_base = os.path.basename(ckan_input)
+        ckan_line_archive = os.path.join(todays_date, todays_time, ckan_line_base)
+        os.remove(ckan_input)
+finally:
+    if record_executor:
+        record_executor.shutdown(wait=True)
+    hash_executor.shutdown(wait=True)
+    retry_writer.close()
+    dead_letter_writer.close()
+
+elapsed = time.time() - start_time
+total_records = sum(record_counts.values())
+logger.info('Processed {0} records in {1:.1f} s ({2:.1f} records/s) with {3} workers: {4}'.format(
+    total_records, elapsed, total_records / elapsed if elapsed else 0, upload_workers,
+    ', '.join('{0} {1}'.format(count, outcome) for outcome, count in sorted(record_counts.items()))))
+logger.info('Metadata patches: {0} sent, {1} skipped as unchanged'.format(patch_counts['sent'],
+                                                                          patch_counts['skipped']))
+logger.info(ckan.summary())
+logger.info(publication_ledger.summary())
+ckan.close()
+publication_ledger.close()
 exit(0)
@@ -1,13 +1,13 @@
 
 import ConfigParser
 import logging
-import requests.exceptions
 import traceback
 from azure.storage.blob import BlockBlobService
 from ckan.logic import NotFound
-from ckanapi import RemoteCKAN
 from datetime import datetime
-from dateutil import parser as dateparser
+from obd_ckan import PortalUnavailable, ckan_client
+from obd_dates import parse_date
+from obd_ledger import PublicationLedger
 # noinspection PyPackageRequirements
 from azure.common import AzureMissingResourceHttpError
 # noinspection PyUnresolvedReferences
@@ -24,6 +24,14 @@ block_blob_service = BlockBlobService(Config.get('azure-blob-storage', 'account_
 
 ckan_container = Config.get('azure-blob-storage', 'account_obd_container')
 
+# CKAN API client shared by all the calls of this run
+ckan = ckan_client(Config)
+
+# Publication ledger of obd_03. Deleted datasets are removed from it.
+publication_ledger = None
+if Config.has_option('working', 'publication_ledger'):
+    publication_ledger = PublicationLedger(Config.get('working', 'publication_ledger'))
+
 # Setup logging
 
 logger = logging.getLogger('base')
@@ -42,21 +50,18 @@ def get_ckan_record(record_id):
     :return: The CKAN package, or an empty dict if the dataset could not be retrieved
     """
 
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    user_agent = Config.get('web', 'user_agent')
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent) as ckan_instance:
-        package_record = {}
-        try:
-            package_record = ckan_instance.action.package_show(id=record_id)
+    package_record = {}
+    try:
+        package_record = ckan.anonymous.action.package_show(id=record_id)
 
-        except NotFound:
-            # This is a new record!
-            logger.info('get_ckan_record(): Cannot find record {0}'.format(record_id))
-        except requests.exceptions.ConnectionError as ce:
-            logger.error('get_ckan_record(): Fatal connection error {0}'.format(ce.message))
-            exit(code=500)
+    except NotFound:
+        # This is a new record!
+        logger.info('get_ckan_record(): Cannot find record {0}'.format(record_id))
+    except PortalUnavailable as ce:
+        logger.error('get_ckan_record(): Portal unavailable {0}'.format(ce.message))
+        exit(code=500)
 
-        return package_record
+    return package_record
 
 
 def delete_blob(container, blob_name):
@@ -86,47 +91,46 @@ def delete_ckan_record(package_id):
         return
 
     # Get rid of the resource
-    remote_ckan_url = Config.get('ckan', 'remote_url')
-    remote_ckan_api = Config.get('ckan', 'remote_api_key')
-    user_agent = Config.get('web', 'user_agent')
-
-    with RemoteCKAN(remote_ckan_url, user_agent=user_agent, apikey=remote_ckan_api) as ckan_instance:
-        try:
-            delete_blob(ckan_container, 'resources/{0}/{1}'.format(package_record['resources'][0]['id'],
-                                                                   package_record['resources'][0]['name'].lower()))
-            ckan_instance.action.package_delete(id=package_record['id'])
-            ckan_instance.action.dataset_purge(id=package_record['id'])
-            logger.info("Deleted expired CKAN record {0}".format(package_record['id']))
-        except Exception as ex:
-            logger.error("delete_ckan_record(): {0}".format(ex.message))
-
-
-obd_ckan_url = Config.get('ckan', 'remote_url')
-obd_ua = Config.get('web', 'user_agent')
+    try:
+        delete_blob(ckan_container, 'resources/{0}/{1}'.format(package_record['resources'][0]['id'],
+                                                               package_record['resources'][0]['name'].lower()))
+        ckan.authorized.action.package_delete(id=package_record['id'])
+        ckan.authorized.action.dataset_purge(id=package_record['id'])
+        if publication_ledger:
+            publication_ledger.remove(package_record['id'])
+        logger.info("Deleted expired CKAN record {0}".format(package_record['id']))
+    except Exception as ex:
+        logger.error("delete_ckan_record(): {0}".format(ex.message))
+
+
 packages = []
 offset = 0
 right_now = datetime.utcnow()
 
-with RemoteCKAN(obd_ckan_url, user_agent=obd_ua) as obd_ckan:
-    while True:
-        # Page through a list of all datasets on the site
-        try:
-            packages = obd_ckan.action.package_list(limit=100, offset=offset)
-            if len(packages) == 0:
-                break
-            for dataset_id in packages:
-                offset += 1
-                package = get_ckan_record(dataset_id)
-                if 'date_expires' in package:
-                    try:
-                        expires_on = dateparser.parse(package['date_expires'])
-                        if expires_on <= right_now:
-                            delete_ckan_record(package['id'])
-                            logger.info("Deleted record {0} which expired on {1}".format(package['id'],
-                                                                                         package['date_expires']))
-                    except ValueError as ve:
-                        logger.error(ve.message)
-
-        except Exception as xx:
-            logger.error(xx.message)
-            logger.error(traceback.format_exc())
+while True:
+    # Page through a list of all datasets on the site
+    try:
+        packages = ckan.anonymous.action.package_list(limit=100, offset=offset)
+        if len(packages) == 0:
+            break
+        for dataset_id in packages:
+            offset += 1
+            package = get_ckan_record(dataset_id)
+            if 'date_expires' in package:
+                try:
+                    expires_on = parse_date(package['date_expires'])
+                    if expires_on <= right_now:
+                        delete_ckan_record(package['id'])
+                        logger.info("Deleted record {0} which expired on {1}".format(package['id'],
+                                                                                     package['date_expires']))
+                except ValueError as ve:
+                    logger.error(ve.message)
+
+    except Exception as xx:
+        logger.error(xx.message)
+        logger.error(traceback.format_exc())
+
+logger.info(ckan.summary())
+ckan.close()
+if publication_ledger:
+    publication_ledger.close()
@@ -0,0 +1,181 @@
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import simplejson as json
+import threading
+from tempfile import mkstemp
+
+logger = logging.getLogger('base')
+
+
+class StoreWriter(object):
+    """
+    Writable file object that compresses data into the archive store while hashing it. The object is
+    only added to the store when the writer is closed, and is discarded if the store already holds it.
+    Data must be written in order; seeking is not supported.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.digest = None
+        self.size = 0
+        self.hash = hashlib.sha256()
+        fd, self.temp_file = mkstemp(dir=store.temp_dir)
+        self.raw_file = os.fdopen(fd, 'wb')
+        self.gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw_file, mtime=0)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.gzip_file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Finish writing and add the object to the store
+        :return: SHA-256 hex digest of the uncompressed data
+        """
+        if self.digest:
+            return self.digest
+        self.gzip_file.close()
+        self.raw_file.close()
+        self.digest = self.hash.hexdigest()
+        object_file = self.store.object_path(self.digest)
+        if os.path.exists(object_file):
+            os.remove(self.temp_file)
+        else:
+            if not os.path.isdir(os.path.dirname(object_file)):
+                try:
+                    os.makedirs(os.path.dirname(object_file), 0o775)
+                except OSError:
+                    # Created by another writer in the meantime
+                    pass
+            os.rename(self.temp_file, object_file)
+        self.store.record(self.name, self.digest, self.size)
+        return self.digest
+
+    def abort(self):
+        """
+        Discard the partially written object
+        """
+        self.gzip_file.close()
+        self.raw_file.close()
+        os.remove(self.temp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+class ArchiveStore(object):
+    """
+    Content-addressed archive of the files handled by the import scripts. Each distinct file is stored once,
+    gzip compressed, under its SHA-256 hash. A manifest per run records the original name and hash of every
+    file archived by that run, so the files of any run can be restored.
+
+    Layout:
+        objects/<first 2 hex digits>/<sha256>.gz
+        manifests/<run>.jsonl
+    """
+
+    def __init__(self, root, run=None):
+        """
+        :param root: Directory holding the archive store
+        :param run: Name of the current run. Required to add files to the store.
+        """
+        self.root = root
+        self.run = run
+        self.lock = threading.Lock()
+        self.temp_dir = os.path.join(root, 'tmp')
+        self.manifest_dir = os.path.join(root, 'manifests')
+        for store_dir in (self.temp_dir, self.manifest_dir, os.path.join(root, 'objects')):
+            if not os.path.isdir(store_dir):
+                os.makedirs(store_dir, 0o775)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.gz')
+
+    def manifest_path(self, run):
+        return os.path.join(self.manifest_dir, run + '.jsonl')
+
+    def writer(self, name):
+        """
+        :param name: Original file name to record in the run manifest
+        :return: StoreWriter to stream the file contents to
+        """
+        assert self.run, 'A run name is required to add files to the archive store'
+        return StoreWriter(self, name)
+
+    def add_file(self, filename, name=None):
+        """
+        Add a local file to the store
+        :param filename: Path to the file
+        :param name: Name to record in the manifest, defaults to the file's base name
+        :return: SHA-256 hex digest of the file
+        """
+        with open(filename, 'rb') as source, self.writer(name or os.path.basename(filename)) as writer:
+            shutil.copyfileobj(source, writer, 1024 * 1024)
+        return writer.digest
+
+    def add_bytes(self, data, name):
+        """
+        Add an in-memory file to the store
+        :param data: File contents
+        :param name: Name to record in the manifest
+        :return: SHA-256 hex digest of the data
+        """
+        with self.writer(name) as writer:
+            writer.write(data)
+        return writer.digest
+
+    def record(self, name, digest, size):
+        """
+        Append an entry to the current run's manifest
+        """
+        entry = json.dumps({'name': name, 'hash': digest, 'size': size})
+        with self.lock:
+            with open(self.manifest_path(self.run), 'a') as manifest_file:
+                manifest_file.write(entry + '\n')
+
+    def runs(self):
+        """
+        :return: Sorted list of the run names with a manifest in the store
+        """
+        return sorted(os.path.splitext(m)[0] for m in os.listdir(self.manifest_dir) if m.endswith('.jsonl'))
+
+    def manifest(self, run):
+        """
+        :return: List of the manifest entries for a run
+        """
+        with open(self.manifest_path(run), 'r') as manifest_file:
+            return [json.loads(line) for line in manifest_file if line.strip()]
+
+    def restore(self, run, dest_dir, names=None):
+        """
+        Restore the files archived by a run
+        :param run: Run name
+        :param dest_dir: Directory to write the restored files to
+        :param names: Optional list of file names to restore. All the files of the run are restored by default.
+        :return: List of the restored file paths
+        """
+        restored = []
+        for entry in self.manifest(run):
+            if names and entry['name'] not in names:
+                continue
+            dest_file = os.path.join(dest_dir, os.path.basename(entry['name']))
+            with gzip.open(self.object_path(entry['hash']), 'rb') as source, open(dest_file, 'wb') as dest:
+                shutil.copyfileobj(source, dest, 1024 * 1024)
+            logger.info('Restored {0} from {1}'.format(entry['name'], entry['hash']))
+            restored.append(dest_file)
+        return restored
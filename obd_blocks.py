@@ -0,0 +1,147 @@
+
+import base64
+import hashlib
+import os
+import threading
+from azure.common import AzureMissingResourceHttpError
+from concurrent.futures import ThreadPoolExecutor, wait
+# noinspection PyPackageRequirements
+from azure.storage.blob.models import BlobBlock, BlockListType, ContentSettings
+
+# Limits of the block blob API
+MIN_BLOCK_SIZE = 4 * 1024 * 1024
+MAX_BLOCK_SIZE = 100 * 1024 * 1024
+MAX_BLOCKS = 50000
+
+# Number of blocks a large file is split into, so its blocks are uploaded in parallel without making each
+# request small
+TARGET_BLOCKS = 256
+
+
+class BlobSlots(object):
+    """
+    Limit on the blob storage connections in use at the same time. A call takes one slot for each connection
+    it opens. Calls taking several slots take them one at a time, one call at a time, so two of them never each
+    hold part of the slots and wait for each other.
+    """
+
+    def __init__(self, count):
+        """
+        :param count: Number of connections
+        """
+        self.count = count
+        self.slots = threading.BoundedSemaphore(count)
+        self.lock = threading.Lock()
+
+    def acquire(self, connections=1):
+        """
+        :param connections: Number of connections the call opens. Calls opening more than count take count slots.
+        :return: Number of slots taken
+        """
+        connections = min(connections, self.count)
+        if connections == 1:
+            self.slots.acquire()
+        else:
+            with self.lock:
+                for _ in range(connections):
+                    self.slots.acquire()
+        return connections
+
+    def release(self, connections=1):
+        for _ in range(connections):
+            self.slots.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def block_size_for(file_size):
+    """
+    Get the block size used to upload a file. It only depends on the file size, so an upload that is resumed
+    splits the file in the same blocks.
+    :param file_size: Size of the file in bytes
+    :return: Block size in bytes, a multiple of 1 MiB
+    """
+    mib = 1024 * 1024
+    block_size = -(-file_size // TARGET_BLOCKS // mib) * mib
+    # Files over TARGET_BLOCKS * MAX_BLOCK_SIZE use more blocks, up to MAX_BLOCKS
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, block_size))
+
+
+def block_id(index, block):
+    """
+    Block IDs are made from the position and the content of the block, so a block already in storage is only
+    reused if it holds the same data. All the IDs of a blob have the same length.
+    """
+    return base64.b64encode('{0:05d}-{1}'.format(index, hashlib.md5(block).hexdigest()))
+
+
+def stored_block_ids(blob_service, container, blob_name):
+    """
+    :return: Set of the IDs of the blocks of a blob, committed or staged by an upload that did not finish
+    """
+    try:
+        block_list = blob_service.get_block_list(container, blob_name, block_list_type=BlockListType.All)
+    except AzureMissingResourceHttpError:
+        return set()
+    return set(block.id for block in block_list.committed_blocks + block_list.uncommitted_blocks)
+
+
+def upload_blocks(get_blob_service, container, blob_name, local_name, connections=4, slots=None,
+                  content_type=None):
+    """
+    Upload a file to a block blob, sending its blocks in parallel, and commit the blob once every block is
+    stored. Blocks already in storage, from the current blob or from an upload that failed, are not sent again.
+    Nothing changes in the blob until it is committed.
+    :param get_blob_service: Function returning the BlockBlobService of the current thread
+    :param container: Azure container name
+    :param blob_name: Full name of the blob
+    :param local_name: Path of the file to upload
+    :param connections: Number of blocks sent at the same time
+    :param slots: Optional BlobSlots shared with other blob calls, one is taken for each call
+    :param content_type: MIME type of the blob
+    :return: Tuple of the number of blocks sent and of blocks already in storage. Azure errors are raised.
+    """
+    if slots is None:
+        slots = BlobSlots(connections)
+    block_size = block_size_for(os.path.getsize(local_name))
+    with slots:
+        stored_ids = stored_block_ids(get_blob_service(), container, blob_name)
+    block_list = []
+    futures = []
+    # Limit the number of blocks read ahead of the uploads
+    read_ahead = threading.BoundedSemaphore(connections * 2)
+
+    def put_block(block, new_block_id):
+        try:
+            with slots:
+                get_blob_service().put_block(container, blob_name, block, new_block_id)
+        finally:
+            read_ahead.release()
+
+    executor = ThreadPoolExecutor(max_workers=connections)
+    try:
+        with open(local_name, 'rb') as f:
+            for index, block in enumerate(iter(lambda: f.read(block_size), b'')):
+                new_block_id = block_id(index, block)
+                block_list.append(BlobBlock(id=new_block_id))
+                if new_block_id in stored_ids:
+                    continue
+                read_ahead.acquire()
+                futures.append(executor.submit(put_block, block, new_block_id))
+                if any(future.done() and future.exception() for future in futures[-connections:]):
+                    break
+    finally:
+        wait(futures)
+        executor.shutdown()
+    for future in futures:
+        if future.exception():
+            raise future.exception()
+
+    with slots:
+        get_blob_service().put_block_list(container, blob_name, block_list,
+                                          content_settings=ContentSettings(content_type=content_type))
+    return len(futures), len(block_list) - len(futures)
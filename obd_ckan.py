@@ -0,0 +1,373 @@
+
+import logging
+import random
+import requests
+import threading
+import time
+from ckanapi import RemoteCKAN
+from ckanapi.errors import CKANAPIError
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('base')
+
+# Actions that give the same result when they are sent again, so they are retried after any transient failure.
+# Other actions are only retried when the portal did not receive or did not start processing the request.
+IDEMPOTENT_ACTIONS = frozenset(['package_show', 'package_search', 'package_list', 'resource_show', 'status_show',
+                                'package_patch', 'resource_patch'])
+
+# HTTP status codes returned when the portal is overloaded or unavailable
+TRANSIENT_STATUS = frozenset([429, 500, 502, 503, 504])
+
+# HTTP status codes returned before the request is processed
+REJECTED_STATUS = frozenset([429, 503])
+
+
+class PortalUnavailable(CKANAPIError):
+    """
+    Raised when a CKAN API call failed on every attempt because the portal could not be reached, timed out or
+    returned a server error
+    """
+    def __init__(self, message):
+        super(PortalUnavailable, self).__init__(message)
+
+
+class CircuitOpen(PortalUnavailable):
+    """
+    Raised without calling the portal while the circuit breaker is open
+    """
+    def __init__(self, message):
+        super(CircuitOpen, self).__init__(message)
+
+
+class TransientResponse(Exception):
+    """
+    Server error response from the portal, raised so the call can be retried
+    """
+    def __init__(self, status, response):
+        super(TransientResponse, self).__init__('HTTP {0}'.format(status))
+        self.status = status
+        self.response = response
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    HTTP adapter keeping track of the connection pools it hands out, so the number of requests and of new
+    connections can be reported
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.pools = set()
+        self.pools_lock = threading.Lock()
+        super(CountingAdapter, self).__init__(*args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super(CountingAdapter, self).get_connection(url, proxies)
+        with self.pools_lock:
+            self.pools.add(pool)
+        return pool
+
+    def counts(self):
+        """
+        :return: Tuple of the number of requests sent and of connections opened
+        """
+        with self.pools_lock:
+            pools = list(self.pools)
+        return sum(pool.num_requests for pool in pools), sum(pool.num_connections for pool in pools)
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling the portal after a run of consecutive failures. Once reset_seconds have passed, one call is let
+    through, and the breaker closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=10, reset_seconds=30.0):
+        """
+        :param failure_threshold: Number of consecutive failed calls that opens the breaker. 0 never opens it.
+        :param reset_seconds: Time the breaker stays open before a trial call is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = None
+        self.trial_started = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if a call can be sent to the portal
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            now = time.time()
+            if now - self.opened < self.reset_seconds:
+                return False
+            # Half open: let one trial call through. A trial that never reports back is replaced.
+            if self.trial_started is None or now - self.trial_started >= self.reset_seconds:
+                self.trial_started = now
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info('CKAN circuit breaker closed, the portal is responding again')
+            self.failures = 0
+            self.opened = None
+            self.trial_started = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened is not None:
+                # The trial call failed, stay open for another reset period
+                self.opened = time.time()
+                self.trial_started = None
+            elif self.failure_threshold and self.failures >= self.failure_threshold:
+                logger.error('CKAN circuit breaker opened after {0} consecutive failures'.format(self.failures))
+                self.opened = time.time()
+                self.trips += 1
+
+
+class AimdLimiter(object):
+    """
+    Limit the number of CKAN API calls in flight with additive increase, multiplicative decrease. Every call
+    that answers within the latency target raises the limit by 1/limit, so it grows by about one for each
+    round of calls. A failed or slow call divides the limit by two. The calls already in flight at that time
+    report the same overload, so they do not lower it again.
+    """
+
+    def __init__(self, maximum, minimum=1, latency_target=2.0, decrease_factor=0.5):
+        """
+        :param maximum: Highest number of calls in flight, and the starting limit
+        :param minimum: Lowest number of calls in flight
+        :param latency_target: Call duration in seconds above which the portal is considered overloaded.
+                               0 only reacts to failures.
+        :param decrease_factor: Factor applied to the limit on overload
+        """
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.limit = float(self.maximum)
+        self.lowest = self.maximum
+        self.decreases = 0
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until a call can be sent
+        :return: Time the call started, to pass to release()
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started, healthy):
+        """
+        Record the end of a call and adjust the limit
+        :param started: Value returned by acquire()
+        :param healthy: False if the call failed because of the portal
+        """
+        now = time.time()
+        with self.condition:
+            self.in_flight -= 1
+            if not healthy or (self.latency_target and now - started > self.latency_target):
+                if started >= self.last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+                    self.decreases += 1
+                    self.lowest = min(self.lowest, int(self.limit))
+                    logger.debug('CKAN API concurrency lowered to {0}'.format(int(self.limit)))
+            elif self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class ResilientCKAN(RemoteCKAN):
+    """
+    RemoteCKAN sending its calls through the retry, circuit breaker and concurrency control of a CkanClient
+    """
+
+    def __init__(self, address, client, **kwargs):
+        super(ResilientCKAN, self).__init__(address, **kwargs)
+        self.client = client
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None, files=None, requests_kwargs=None):
+        requests_kwargs = requests_kwargs or {}
+        requests_kwargs.setdefault('timeout', self.client.timeout)
+        send = super(ResilientCKAN, self).call_action
+        return self.client.call(action, files,
+                                lambda: send(action, data_dict, context, apikey, files, requests_kwargs))
+
+    def _request_fn(self, url, data, headers, files, requests_kwargs):
+        status, response = super(ResilientCKAN, self)._request_fn(url, data, headers, files, requests_kwargs)
+        if status in TRANSIENT_STATUS:
+            raise TransientResponse(status, response)
+        return status, response
+
+    def _request_fn_get(self, url, data_dict, headers, requests_kwargs):
+        status, response = super(ResilientCKAN, self)._request_fn_get(url, data_dict, headers, requests_kwargs)
+        if status in TRANSIENT_STATUS:
+            raise TransientResponse(status, response)
+        return status, response
+
+
+class CkanClient(object):
+    """
+    CKAN API client shared by all the calls of a script. The anonymous and the authenticated RemoteCKAN
+    instances use one requests session, so the connections to the portal are kept alive and reused
+    instead of being opened again for every call.
+    Calls that fail because the portal is unreachable, times out or returns a server error are retried with
+    jittered exponential backoff, and raise PortalUnavailable when every attempt failed. A circuit breaker stops
+    the calls while the portal keeps failing, and the number of calls in flight follows the portal's health.
+    """
+
+    def __init__(self, remote_url, api_key=None, user_agent=None, pool_size=10, timeout=60.0, max_retries=4,
+                 backoff_seconds=0.5, backoff_max_seconds=30.0, breaker=None, limiter=None):
+        """
+        :param remote_url: CKAN portal URL
+        :param api_key: CKAN API key for the calls that change the portal
+        :param user_agent: HTTP user agent
+        :param pool_size: Number of connections kept open to the portal
+        :param timeout: Seconds to wait for the portal to connect or answer
+        :param max_retries: Number of times a failed call is sent again
+        :param backoff_seconds: Longest wait before the first retry. It doubles for each following retry.
+        :param backoff_max_seconds: Longest wait before a retry
+        :param breaker: CircuitBreaker, by default one that never opens
+        :param limiter: AimdLimiter, by default one allowing pool_size calls in flight
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.breaker = breaker or CircuitBreaker(0)
+        self.limiter = limiter or AimdLimiter(pool_size, latency_target=0)
+        self.retries = 0
+        self.failures = 0
+        self.stats_lock = threading.Lock()
+        self.adapter = CountingAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.anonymous = ResilientCKAN(remote_url, self, user_agent=user_agent, session=self.session)
+        self.authorized = ResilientCKAN(remote_url, self, apikey=api_key, user_agent=user_agent,
+                                        session=self.session)
+
+    @staticmethod
+    def can_retry(action, error):
+        """
+        :return: True if the action can be sent again after the error
+        """
+        if action in IDEMPOTENT_ACTIONS:
+            return True
+        if isinstance(error, TransientResponse):
+            return error.status in REJECTED_STATUS
+        return isinstance(error, requests.exceptions.ConnectTimeout)
+
+    def call(self, action, files, send):
+        """
+        Send a CKAN API call, retrying it after transient failures
+        :param action: Name of the CKAN action
+        :param files: Files uploaded by the call, rewound before a retry
+        :param send: Function sending the call once
+        :return: Result of the call
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpen('CKAN portal unavailable, {0} was not sent'.format(action))
+            started = self.limiter.acquire()
+            try:
+                result = send()
+            except (TransientResponse, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                self.limiter.release(started, False)
+                self.breaker.failure()
+                error = ex
+            except Exception:
+                # The portal answered, ex. NotFound or ValidationError
+                self.limiter.release(started, True)
+                self.breaker.success()
+                raise
+            else:
+                self.limiter.release(started, True)
+                self.breaker.success()
+                return result
+
+            attempt += 1
+            if attempt > self.max_retries or not self.can_retry(action, error):
+                with self.stats_lock:
+                    self.failures += 1
+                raise PortalUnavailable('CKAN {0} failed after {1} attempts: {2}'.format(action, attempt, error))
+            # Full jitter, so the workers that failed together do not retry together
+            delay = random.uniform(0, min(self.backoff_max_seconds, self.backoff_seconds * 2 ** (attempt - 1)))
+            logger.warn('CKAN {0} failed ({1}), retrying in {2:.1f} s'.format(action, error, delay))
+            with self.stats_lock:
+                self.retries += 1
+            for upload in (files or {}).values():
+                if hasattr(upload, 'seek'):
+                    upload.seek(0)
+            time.sleep(delay)
+
+    def summary(self):
+        """
+        :return: Description of the API requests sent, the connections opened for them, and the retries
+        """
+        requests_sent, connections = self.adapter.counts()
+        return ('CKAN API: {0} requests over {1} connections, {2} reused, {3} retried, {4} failed, '
+                'circuit breaker opened {5} times, concurrency {6} to {7} of {8}').format(
+            requests_sent, connections, max(0, requests_sent - connections), self.retries, self.failures,
+            self.breaker.trips, self.limiter.lowest, int(self.limiter.limit), self.limiter.maximum)
+
+    def close(self):
+        self.session.close()
+
+
+def ckan_client(config, workers=1):
+    """
+    Create the CKAN client from the [ckan] and [web] sections of azure.ini. The optional options are
+    ckan_pool_size, the number of connections kept open, ckan_max_concurrency, ckan_timeout, ckan_max_retries,
+    ckan_backoff_seconds, ckan_latency_target, ckan_breaker_failures and ckan_breaker_reset_seconds.
+    :param config: ConfigParser holding azure.ini
+    :param workers: Number of threads using the client. By default, each can have a call in flight.
+    :return: CkanClient
+    """
+    api_key = None
+    if config.has_option('ckan', 'remote_api_key'):
+        api_key = config.get('ckan', 'remote_api_key')
+    pool_size = 10
+    if config.has_option('ckan', 'ckan_pool_size'):
+        pool_size = max(1, config.getint('ckan', 'ckan_pool_size'))
+    max_concurrency = workers
+    if config.has_option('ckan', 'ckan_max_concurrency'):
+        max_concurrency = max(1, min(workers, config.getint('ckan', 'ckan_max_concurrency')))
+    # The pool keeps a connection for each call in flight
+    pool_size = max(pool_size, max_concurrency)
+    timeout = 60.0
+    if config.has_option('ckan', 'ckan_timeout'):
+        timeout = config.getfloat('ckan', 'ckan_timeout')
+    max_retries = 4
+    if config.has_option('ckan', 'ckan_max_retries'):
+        max_retries = max(0, config.getint('ckan', 'ckan_max_retries'))
+    backoff_seconds = 0.5
+    if config.has_option('ckan', 'ckan_backoff_seconds'):
+        backoff_seconds = config.getfloat('ckan', 'ckan_backoff_seconds')
+    latency_target = 5.0
+    if config.has_option('ckan', 'ckan_latency_target'):
+        latency_target = config.getfloat('ckan', 'ckan_latency_target')
+    breaker_failures = 20
+    if config.has_option('ckan', 'ckan_breaker_failures'):
+        breaker_failures = max(0, config.getint('ckan', 'ckan_breaker_failures'))
+    breaker_reset_seconds = 60.0
+    if config.has_option('ckan', 'ckan_breaker_reset_seconds'):
+        breaker_reset_seconds = config.getfloat('ckan', 'ckan_breaker_reset_seconds')
+    return CkanClient(config.get('ckan', 'remote_url'), api_key, config.get('web', 'user_agent'), pool_size,
+                      timeout=timeout, max_retries=max_retries, backoff_seconds=backoff_seconds,
+                      breaker=CircuitBreaker(breaker_failures, breaker_reset_seconds),
+                      limiter=AimdLimiter(max_concurrency, latency_target=latency_target))
@@ -0,0 +1,151 @@
+
+import ConfigParser
+import hashlib
+import logging
+import os
+import uuid
+from ckan.lib.munge import munge_filename
+from datetime import datetime
+from obd_dates import parse_date
+from obd_mapper import MissingRequiredFieldException, apply_mapping, compile_mapping
+from obd_presets import load_lookup_tables
+from obd_validate import PackageValidator
+
+# CKAN Open Canada federal department identifiers
+oc_organizations = {
+    "Canadian Heritage": '9EEB1859-D658-4E1B-A0E0-45CFAB4E3E5A',
+    "Environment Canada": '49E2ADF4-AD7A-43EB-85C8-6433D37ED62C',
+    "Natural Resources Canada": '9391E0A2-9717-4755-B548-4499C21F917B',
+    "Treasury Board of Canada Secretariat": '81765FCD-32B3-4708-A593-3AA00705E62B'
+}
+
+# Dataset IDs are name based UUIDs of the portal URL of the document. The namespace and URL prefix are hashed
+# once, each record only hashes its GCDocs ID.
+DATASET_ID_PREFIX = hashlib.sha1(uuid.NAMESPACE_URL.bytes + 'http://obd.open.canada.ca/')
+
+# Load Azure and file directory configuration information
+Config = ConfigParser.ConfigParser()
+Config.read('azure.ini')
+
+# Cache file for the lookup tables compiled from the scheming presets, by default in the schemas directory
+presets_cache_file = None
+if Config.has_option('working', 'presets_cache'):
+    presets_cache_file = Config.get('working', 'presets_cache')
+
+logger = logging.getLogger('base')
+
+
+def load_oc_resource_format():
+    """
+    Read in the CKAN Open Canada resource format identifiers. The lookup tables are compiled from
+    schemas/presets.yaml once and then read from the presets cache.
+    :return:
+    """
+    tables = load_lookup_tables('schemas', presets_cache_file)
+    return [tables['resource_formats'], tables['resource_types'], tables['audience_types']]
+
+
+oc_resource_formats, oc_resource_types, oc_audience_types = load_oc_resource_format()
+
+# Mapping of the GCDocs metadata to the CKAN dataset fields, compiled once
+dataset_mapping = compile_mapping(os.path.join('schemas', 'doc_mapping.yaml'),
+                                  {'organizations': oc_organizations,
+                                   'audience_types': oc_audience_types,
+                                   'resource_types': oc_resource_types,
+                                   'resource_formats': oc_resource_formats})
+
+# Rules of the Open by Default scheming schema, checked before the records are uploaded
+package_validator = PackageValidator(load_lookup_tables('schemas', presets_cache_file))
+
+
+def convert(fields, filename):
+    """
+    Convert the basic imported JSON document metadata to CKAN Package JSON. The dataset fields are set by the
+    mapping compiled from schemas/doc_mapping.yaml.
+    :param fields: JSON file notation
+    :param filename: CKAN JSON lines files to write to
+    :return: CKAN package object
+    """
+
+    # Initialize the record
+    obd_ds = {'collection': 'publication', 'id': dataset_id(filename)}
+
+    # Check Expiration date first. If the document has expired, then most of these fields will NOT be present
+
+    if 'Expiration Date' in fields:
+        obd_ds['date_expires'] = fields['Expiration Date']
+    else:
+        right_now = datetime.utcnow()
+        default_expiry = datetime(right_now.year + 2, right_now.month, right_now.day, right_now.hour, 0, 0)
+        obd_ds['date_expires'] = default_expiry.isoformat()
+    active = parse_date(obd_ds['date_expires']) > datetime.utcnow()
+
+    if active:
+        apply_mapping(dataset_mapping, fields, obd_ds)
+        logger.info('Processed incoming XML for document {0}'.format(fields['GCfile']))
+
+    obd_ds['resources'] = [convert_resource(fields, filename, active)]
+    return obd_ds
+
+
+def dataset_id(filename):
+    """
+    :param filename: GCDocs file name of the document
+    :return: Dataset ID, the same as uuid5(NAMESPACE_URL, 'http://obd.open.canada.ca/' + GCDocs ID)
+    """
+    url_hash = DATASET_ID_PREFIX.copy()
+    url_hash.update(os.path.splitext(filename)[0])
+    return str(uuid.UUID(bytes=url_hash.digest()[:16], version=5))
+
+
+def convert_resource(fields, filename, active):
+    """
+    Build the CKAN resource for a GCDocs document
+    :param fields: JSON file notation
+    :param filename: GCDocs file name of the document
+    :param active: False if the document has expired
+    :return: CKAN resource object
+    """
+    obd_res = {}
+    res_name = munge_filename(os.path.basename(filename))
+    obd_res['name_translated'] = {'en': res_name, 'fr': res_name}
+
+    # This is not ideal, but GCDocs does not provide the information we require
+    if len(filename.split('.')) > 1:
+        obd_res['format'] = filename.split('.')[1].upper()
+    else:
+        obd_res['format'] = ''
+    if obd_res['format'] not in oc_resource_formats:
+        obd_res['format'] = 'other'
+
+    # Placeholder - the file itself needs to be uploaded with the CKAN API
+    obd_res['url'] = 'http://obd.open.canada.ca/' + filename
+
+    if active:
+        obd_res['language'] = []
+        if ('Language' in fields):
+            if fields['Language'][:3] == 'fra':
+                obd_res['language'].append('fr')
+            elif fields['Language'][:3] == 'eng':
+                obd_res['language'].append('en')
+            elif len(obd_res['language']) == 0:
+                raise MissingRequiredFieldException("Missing valid value for required field Language in {0}".format(filename))
+        elif ('Language/Langue' in fields):
+            if fields['Language/Langue'][:2].lower() == 'fr':
+                obd_res['language'].append('fr')
+            elif fields['Language/Langue'][:2].lower() == 'en':
+                obd_res['language'].append('en')
+            else:
+                raise MissingRequiredFieldException("Missing valid value for required field Language/Langue in {0}".format(filename))
+        else:
+            raise MissingRequiredFieldException("Missing required field Language or Language/Langue in {0}".format(filename))
+
+    if not fields.get('Resource Type'):
+        obd_res['resource_type'] = 'guide'
+    else:
+        obd_res_type = fields['Resource Type'].split('|')[0].strip()
+        if obd_res_type in oc_resource_types:
+            obd_res['resource_type'] = oc_resource_types[obd_res_type]
+        else:
+            obd_res['resource_type'] = 'guide'
+    return obd_res
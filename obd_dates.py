@@ -0,0 +1,59 @@
+
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from dateutil import parser as dateparser
+
+# Naive ISO 8601 dates and times, as written by convert(): 2018-01-31, 2018-01-31T14:05:00 or 2018-01-31 14:05:00.
+# Anything else, including time zones, is left to dateutil.
+ISO_DATE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?$')
+
+CACHE_SIZE = 4096
+
+date_cache = OrderedDict()
+cache_lock = threading.Lock()
+
+
+def parse_iso_date(value):
+    """
+    Parse a naive ISO 8601 date or date and time
+    :param value: Date string
+    :return: datetime, or None if the value is not in one of the supported ISO formats
+    """
+    match = ISO_DATE.match(value)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                        int(fraction.ljust(6, '0')) if fraction else 0)
+    except ValueError:
+        return None
+
+
+def parse_date(value):
+    """
+    Parse a date string. Values in the ISO format written by the conversion are parsed directly, other
+    values are parsed with dateutil. Recent results are cached, since the same expiry dates repeat
+    across many records.
+    :param value: Date string
+    :return: datetime
+    :raise ValueError: if the value cannot be parsed
+    """
+    with cache_lock:
+        parsed = date_cache.pop(value, None)
+        if parsed is not None:
+            # Move the value to the most recently used end of the cache
+            date_cache[value] = parsed
+            return parsed
+
+    parsed = parse_iso_date(value)
+    if parsed is None:
+        parsed = dateparser.parse(value)
+
+    with cache_lock:
+        date_cache[value] = parsed
+        if len(date_cache) > CACHE_SIZE:
+            date_cache.popitem(last=False)
+    return parsed
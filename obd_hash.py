@@ -0,0 +1,87 @@
+
+import hashlib
+import mmap
+import os
+
+# Size of the reads when hashing a file. hashlib releases the GIL for large updates, so files can be hashed
+# on several threads at once.
+BUFFER_SIZE = 1024 * 1024
+
+# Files at least this large are hashed through a memory map instead of reads
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+def hash_file(file_to_hash, algorithms=('sha384',), buffer_size=BUFFER_SIZE):
+    """
+    Compute one or more hash values of a file in a single read
+    :param file_to_hash: Path to the file to hash
+    :param algorithms: hashlib algorithm names, ex. ('md5', 'sha384')
+    :param buffer_size: Size of the reads
+    :return: Dictionary of the hex digests by algorithm name, or None if the file could not be found
+    """
+    if not os.path.isfile(file_to_hash):
+        return None
+    hashes = [(name, hashlib.new(name)) for name in algorithms]
+    with open(file_to_hash, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, buffer_size):
+                    chunk = mapped[offset:offset + buffer_size]
+                    for name, file_hash in hashes:
+                        file_hash.update(chunk)
+            finally:
+                mapped.close()
+        else:
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            while True:
+                length = f.readinto(buf)
+                if not length:
+                    break
+                for name, file_hash in hashes:
+                    file_hash.update(view[:length])
+    return dict((name, file_hash.hexdigest()) for name, file_hash in hashes)
+
+
+class HashingWriter(object):
+    """
+    File-like object hashing the data written to it, so a download can be hashed as it arrives instead of
+    being saved and read again. The data can also be passed on to a file.
+    """
+
+    def __init__(self, algorithms=('sha384',), output_file=None):
+        """
+        :param algorithms: hashlib algorithm names
+        :param output_file: Optional file object to also write the data to
+        """
+        self.hashes = [(name, hashlib.new(name)) for name in algorithms]
+        self.output_file = output_file
+        self.size = 0
+
+    def write(self, data):
+        for name, data_hash in self.hashes:
+            data_hash.update(data)
+        if self.output_file:
+            self.output_file.write(data)
+        self.size += len(data)
+
+    def seek(self, offset, whence=0):
+        # The Azure SDK seeks to the current position before writing each range of a download
+        if (offset, whence) not in ((self.size, 0), (0, 1), (0, 2)):
+            raise IOError('HashingWriter can only be written to in order')
+        return self.size
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        if self.output_file:
+            self.output_file.flush()
+
+    def hexdigests(self):
+        """
+        :return: Dictionary of the hex digests of the data written so far, by algorithm name
+        """
+        return dict((name, data_hash.hexdigest()) for name, data_hash in self.hashes)
@@ -0,0 +1,104 @@
+
+import logging
+import os
+
+logger = logging.getLogger('base')
+
+
+class JsonlWriter(object):
+    """
+    Buffered writer for the CKAN JSON lines output of obd_02. The output can be split into shards of a
+    maximum size. Each shard is written under a .part name and renamed once it is complete, so obd_03 can
+    pick up finished shards while the conversion is still running. obd_03 never reads a .part file, so the
+    source of a record, such as its intake file, is only handed to on_finish once its shard is finished. An
+    archive copy of each shard can be written in the same pass.
+    """
+
+    def __init__(self, dest_dir, file_name, max_bytes=0, archive_writer=None, buffer_size=1024 * 1024,
+                 on_finish=None):
+        """
+        :param dest_dir: Directory to write the JSON lines files to
+        :param file_name: Output file name, ex. ckan_obd_2018-01-01_00-00-00.jsonl. When the output is split,
+                          the shards are numbered, ex. ckan_obd_2018-01-01_00-00-00_0001.jsonl
+        :param max_bytes: Maximum size of a shard, or 0 to write a single file
+        :param archive_writer: Optional function returning a writable file object for the archive copy of a shard
+        :param buffer_size: Size of the output file buffer
+        :param on_finish: Optional function called with the list of the sources of the records of each shard,
+                          once the shard is finished
+        """
+        self.dest_dir = dest_dir
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.archive_writer = archive_writer
+        self.buffer_size = buffer_size
+        self.on_finish = on_finish
+        self.shard_sources = []
+        self.files = []
+        self.shard = 0
+        self.shard_name = None
+        self.shard_size = 0
+        self.output_file = None
+        self.archive_file = None
+
+    def open_shard(self):
+        self.shard += 1
+        if self.max_bytes:
+            base, ext = os.path.splitext(self.file_name)
+            self.shard_name = '{0}_{1:04d}{2}'.format(base, self.shard, ext)
+        else:
+            self.shard_name = self.file_name
+        self.shard_size = 0
+        self.output_file = open(os.path.join(self.dest_dir, self.shard_name + '.part'), 'a', self.buffer_size)
+        if self.archive_writer:
+            self.archive_file = self.archive_writer(self.shard_name)
+
+    def write(self, line, source=None):
+        """
+        Add a record to the output. Nothing is written to disk until the first record.
+        :param line: JSON text of the record, without the line break
+        :param source: Optional value handed to on_finish once the shard holding the record is finished
+        :return: Nothing
+        """
+        if self.output_file and self.max_bytes and self.shard_size + len(line) + 1 > self.max_bytes:
+            self.close_shard()
+        if not self.output_file:
+            self.open_shard()
+        self.output_file.write(line + '\n')
+        if self.archive_file:
+            self.archive_file.write(line + '\n')
+        self.shard_size += len(line) + 1
+        if source is not None:
+            self.shard_sources.append(source)
+
+    def sync(self):
+        """
+        Flush the records written so far to disk
+        :return: Nothing
+        """
+        if self.output_file:
+            self.output_file.flush()
+            os.fsync(self.output_file.fileno())
+
+    def close_shard(self):
+        self.sync()
+        self.output_file.close()
+        shard_file = os.path.join(self.dest_dir, self.shard_name)
+        os.rename(shard_file + '.part', shard_file)
+        if self.archive_file:
+            self.archive_file.close()
+        logger.info('Finished {0} ({1} bytes)'.format(self.shard_name, self.shard_size))
+        self.files.append(shard_file)
+        self.output_file = None
+        self.archive_file = None
+        sources, self.shard_sources = self.shard_sources, []
+        if self.on_finish and sources:
+            self.on_finish(sources)
+
+    def close(self):
+        """
+        Finish the current shard
+        :return: List of the JSON lines files written
+        """
+        if self.output_file:
+            self.close_shard()
+        return self.files
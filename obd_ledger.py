@@ -0,0 +1,329 @@
+
+import hashlib
+import simplejson as json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from obd_dates import parse_date
+
+
+class IntakeLedger(object):
+    """
+    Persistent record of the GCDocs blobs handled by obd_01. Each blob is keyed on its name and ETag, so a
+    rerun can pick up where a failed run stopped, and a blob that was changed in GCDocs is processed again.
+    """
+
+    # Processing stages, in the order they are completed
+    STAGES = ('downloaded', 'archived', 'converted', 'deleted')
+
+    def __init__(self, filename):
+        """
+        :param filename: Path to the SQLite ledger file, or ':memory:' for a ledger that is not kept
+        """
+        self.lock = threading.Lock()
+        self.counters = {'downloads_skipped': 0, 'bytes_skipped': 0, 'parses_skipped': 0, 'deletes_retried': 0}
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS intake_blobs ('
+                        'name TEXT PRIMARY KEY, etag TEXT, size INTEGER, stage TEXT, path TEXT, updated TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS delete_queue (name TEXT PRIMARY KEY, etag TEXT, queued TEXT)')
+        self.db.commit()
+
+    def get(self, name, etag):
+        """
+        Look up the last completed stage of a blob
+        :param name: Blob name
+        :param etag: Current ETag of the blob
+        :return: Tuple of stage and local path, or (None, None) if this version of the blob has not been seen
+        """
+        with self.lock:
+            row = self.db.execute('SELECT stage, path FROM intake_blobs WHERE name = ? AND etag = ?',
+                                  (name, etag)).fetchone()
+        if row:
+            return row[0], row[1]
+        return None, None
+
+    def reached(self, name, etag, stage):
+        """
+        Check if a blob has already completed a processing stage
+        :return: True if the stage, or a later one, was recorded for this version of the blob
+        """
+        current_stage = self.get(name, etag)[0]
+        return current_stage is not None and self.STAGES.index(current_stage) >= self.STAGES.index(stage)
+
+    def path(self, name, etag):
+        """
+        :return: Local path recorded for this version of the blob, or None
+        """
+        return self.get(name, etag)[1]
+
+    def set_stage(self, name, etag, size, stage, path=None):
+        """
+        Record that a blob has completed a processing stage
+        :param name: Blob name
+        :param etag: ETag of the blob that was processed
+        :param size: Size of the blob in bytes
+        :param stage: One of IntakeLedger.STAGES
+        :param path: Local file written for the blob. If None, the previously recorded path is kept.
+        """
+        assert stage in self.STAGES
+        with self.lock:
+            if path is None:
+                row = self.db.execute('SELECT path FROM intake_blobs WHERE name = ? AND etag = ?',
+                                      (name, etag)).fetchone()
+                path = row[0] if row else None
+            self.db.execute('INSERT OR REPLACE INTO intake_blobs (name, etag, size, stage, path, updated) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (name, etag, size, stage, path, datetime.utcnow().isoformat()))
+            self.db.commit()
+
+    def queue_delete(self, name, etag):
+        """
+        Add a blob to the delete queue. Blobs are queued once their local copies have been written.
+        :return: Number of blobs waiting in the queue
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO delete_queue (name, etag, queued) VALUES (?, ?, ?)',
+                            (name, etag, datetime.utcnow().isoformat()))
+            self.db.commit()
+            return self.db.execute('SELECT COUNT(*) FROM delete_queue').fetchone()[0]
+
+    def queued_deletes(self):
+        """
+        :return: List of (name, etag) tuples waiting to be deleted, oldest first
+        """
+        with self.lock:
+            return self.db.execute('SELECT name, etag FROM delete_queue ORDER BY queued').fetchall()
+
+    def delete_done(self, name, etag):
+        """
+        Remove a blob from the delete queue once it has been deleted from the container
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM delete_queue WHERE name = ? AND etag = ?', (name, etag))
+            self.db.execute("UPDATE intake_blobs SET stage = 'deleted', updated = ? WHERE name = ? AND etag = ?",
+                            (datetime.utcnow().isoformat(), name, etag))
+            self.db.commit()
+
+    def count(self, counter, amount=1):
+        """
+        Increase one of the avoided work counters
+        """
+        with self.lock:
+            self.counters[counter] += amount
+
+    def summary(self):
+        """
+        :return: Printable summary of the work avoided by the ledger
+        """
+        return 'Ledger skipped {downloads_skipped} downloads ({bytes_skipped} bytes), ' \
+               '{parses_skipped} XML conversions and retried {deletes_retried} deletes'.format(**self.counters)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def metadata_digest(package_dict):
+    """
+    :param package_dict: CKAN package. The resources are not included in the digest.
+    :return: SHA 1 hash of the normalized JSON text of the package metadata
+    """
+    metadata = dict((key, value) for key, value in package_dict.items() if key != 'resources')
+    return hashlib.sha1(json.dumps(metadata, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class PublicationLedger(object):
+    """
+    Persistent record of the datasets obd_03 has published to the portal: the package ID, the ID and name of
+    its resource, the hash of the last uploaded resource file and a digest of the last written metadata.
+    Entries are refreshed from CKAN when they are older than the verification interval, so most records can
+    be handled without asking the portal for the package. The ledger also keeps the progress made through each
+    JSON lines file, and the number of times a record has failed.
+    """
+
+    def __init__(self, filename, verify_interval=timedelta(hours=24)):
+        """
+        :param filename: Path to the SQLite ledger file, or ':memory:' for a ledger that is not kept
+        :param verify_interval: Time after which an entry is checked against CKAN again
+        """
+        self.lock = threading.Lock()
+        self.verify_interval = verify_interval
+        self.counters = {'lookups_skipped': 0, 'lookups_verified': 0, 'stale_removed': 0}
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS publications ('
+                        'package_id TEXT PRIMARY KEY, resource_id TEXT, resource_name TEXT, resource_hash TEXT, '
+                        'metadata_digest TEXT, verified TEXT, updated TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS upload_checkpoints ('
+                        'file TEXT PRIMARY KEY, size INTEGER, offset INTEGER, record_id TEXT, updated TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS record_failures ('
+                        'record_id TEXT PRIMARY KEY, failures INTEGER, updated TEXT)')
+        self.db.commit()
+
+    def get(self, package_id):
+        """
+        :return: Resource ID, name and hash of the dataset, if it was verified against CKAN recently enough
+        """
+        with self.lock:
+            row = self.db.execute('SELECT resource_id, resource_name, resource_hash, verified FROM publications '
+                                  'WHERE package_id = ?', (package_id,)).fetchone()
+        if not row or datetime.utcnow() - parse_date(row[3]) > self.verify_interval:
+            return None
+        return row[:3]
+
+    def is_current(self, package_id):
+        """
+        :return: True if the dataset was verified against CKAN recently enough
+        """
+        return self.get(package_id) is not None
+
+    def lookup(self, package_id):
+        """
+        Get the recorded state of a dataset, if it was verified against CKAN recently enough
+        :param package_id: CKAN package ID
+        :return: Package with its ID and resource ID, name and hash, in the form returned by package_show,
+                 or None if the dataset must be looked up in CKAN
+        """
+        row = self.get(package_id)
+        if row is None:
+            return None
+        self.count('lookups_skipped')
+        resources = []
+        if row[0]:
+            resources.append({'id': row[0], 'name': row[1], 'hash': row[2] or ''})
+        return {'id': package_id, 'resources': resources}
+
+    def digest(self, package_id):
+        """
+        :return: Metadata digest recorded for the dataset, or None
+        """
+        with self.lock:
+            row = self.db.execute('SELECT metadata_digest FROM publications WHERE package_id = ?',
+                                  (package_id,)).fetchone()
+        return row[0] if row else None
+
+    def record_package(self, package_record):
+        """
+        Record the state of a dataset returned by CKAN. Datasets with more than one resource are not recorded.
+        The metadata digest is cleared, since the metadata may have been edited in the portal: the metadata is
+        compared with the package from CKAN again, and its digest recorded if it matches.
+        :param package_record: Package returned by package_show or package_create
+        """
+        resources = package_record.get('resources', [])
+        if len(resources) > 1:
+            return
+        resource = resources[0] if resources else {}
+        now = datetime.utcnow().isoformat()
+        with self.lock:
+            self.counters['lookups_verified'] += 1
+            self.db.execute('INSERT OR REPLACE INTO publications (package_id, resource_id, resource_name, '
+                            'resource_hash, metadata_digest, verified, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (package_record['id'], resource.get('id'), resource.get('name'), resource.get('hash'),
+                             None, now, now))
+            self.db.commit()
+
+    def record_resource(self, package_id, resource):
+        """
+        Record the resource of a dataset after it was created or updated
+        :param package_id: CKAN package ID
+        :param resource: Resource returned by resource_create or resource_patch
+        """
+        with self.lock:
+            self.db.execute('UPDATE publications SET resource_id = ?, resource_name = ?, resource_hash = ?, '
+                            'updated = ? WHERE package_id = ?',
+                            (resource['id'], resource.get('name'), resource.get('hash'),
+                             datetime.utcnow().isoformat(), package_id))
+            self.db.commit()
+
+    def record_metadata(self, package_id, digest):
+        """
+        Record the digest of the metadata written to a dataset
+        """
+        with self.lock:
+            self.db.execute('UPDATE publications SET metadata_digest = ?, updated = ? WHERE package_id = ?',
+                            (digest, datetime.utcnow().isoformat(), package_id))
+            self.db.commit()
+
+    def remove(self, package_id, stale=False):
+        """
+        Forget a dataset, after it was deleted from the portal or found to differ from the ledger
+        :param package_id: CKAN package ID
+        :param stale: True if the entry did not match the portal
+        """
+        with self.lock:
+            if stale:
+                self.counters['stale_removed'] += 1
+            self.db.execute('DELETE FROM publications WHERE package_id = ?', (package_id,))
+            self.db.commit()
+
+    def checkpoint(self, file_name, size):
+        """
+        Get the position up to which a JSON lines file was processed
+        :param file_name: Name of the JSON lines file
+        :param size: Size of the file. A checkpoint recorded for a file of another size is not used.
+        :return: Tuple of the byte offset of the first unfinished record and the ID of the last finished record,
+                 or (0, None) to start from the beginning
+        """
+        with self.lock:
+            row = self.db.execute('SELECT offset, record_id FROM upload_checkpoints WHERE file = ? AND size = ?',
+                                  (file_name, size)).fetchone()
+        if row:
+            return row[0], row[1]
+        return 0, None
+
+    def set_checkpoint(self, file_name, size, offset, record_id):
+        """
+        Record that all the records of a JSON lines file before an offset are finished
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO upload_checkpoints (file, size, offset, record_id, updated) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (file_name, size, offset, record_id, datetime.utcnow().isoformat()))
+            self.db.commit()
+
+    def clear_checkpoint(self, file_name):
+        """
+        Forget the checkpoint of a JSON lines file once it has been processed completely
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM upload_checkpoints WHERE file = ?', (file_name,))
+            self.db.commit()
+
+    def record_failure(self, record_id):
+        """
+        Count a failed attempt to publish a record
+        :return: Number of times the record has failed
+        """
+        with self.lock:
+            row = self.db.execute('SELECT failures FROM record_failures WHERE record_id = ?',
+                                  (record_id,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            self.db.execute('INSERT OR REPLACE INTO record_failures (record_id, failures, updated) VALUES (?, ?, ?)',
+                            (record_id, failures, datetime.utcnow().isoformat()))
+            self.db.commit()
+        return failures
+
+    def clear_failures(self, record_id):
+        """
+        Forget the failed attempts of a record, once it was published or set aside
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM record_failures WHERE record_id = ?', (record_id,))
+            self.db.commit()
+
+    def count(self, counter, amount=1):
+        """
+        Increase one of the ledger counters
+        """
+        with self.lock:
+            self.counters[counter] += amount
+
+    def summary(self):
+        """
+        :return: Printable summary of the CKAN lookups served by the ledger
+        """
+        return 'Publication ledger served {lookups_skipped} package lookups, verified {lookups_verified} ' \
+               'with CKAN and removed {stale_removed} stale entries'.format(**self.counters)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
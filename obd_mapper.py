@@ -0,0 +1,200 @@
+
+import yaml
+from datetime import datetime
+
+# Returned by a transform when the CKAN field is not set
+OMIT = object()
+
+# Number of distinct GCDocs values kept for each field with a transform or lookup
+CACHE_SIZE = 4096
+
+
+class MissingRequiredFieldException(Exception):
+    def __init__(self, message):
+        super(MissingRequiredFieldException, self).__init__(message)
+
+
+def copy_value(value):
+    """
+    :return: Function returning the constant value. Lists and dicts are copied for every record.
+    """
+    if isinstance(value, (list, dict)):
+        return lambda fields: type(value)(value)
+    return lambda fields: value
+
+
+def copy_result(value):
+    """
+    :return: Copy of a mapped value, with its lists copied, so records never share a dict or list
+    """
+    if isinstance(value, dict):
+        return dict((key, list(item) if isinstance(item, list) else item) for key, item in value.items())
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def compile_transform(transform):
+    """
+    :return: Function converting a source value, or OMIT if the field should not be set
+    """
+    if transform is None:
+        return lambda value: value
+    elif transform == 'first':
+        return lambda value: value.split('|')[0].strip()
+    elif transform == 'pair':
+        def pair(value):
+            parts = value.split('|')
+            if len(parts) == 2:
+                return {'en': parts[0], 'fr': parts[1]}
+            return OMIT
+        return pair
+    elif transform == 'pair_list':
+        def pair_list(value):
+            parts = value.split('|')
+            if len(parts) == 2:
+                return {'en': parts[0].split(','), 'fr': parts[1].split(',')}
+            return {}
+        return pair_list
+    raise ValueError('Unknown transform {0}'.format(transform))
+
+
+def compile_source_field(spec, tables):
+    """
+    :return: Function mapping a GCDocs source field, with optional transform and lookup
+    """
+    source = spec['source']
+    transform = compile_transform(spec.get('transform'))
+    table = tables[spec['lookup']] if 'lookup' in spec else None
+    has_default = 'default' in spec
+    default = spec.get('default')
+
+    def resolve(value):
+        value = transform(value)
+        if value is OMIT or table is None:
+            return value
+        if value not in table:
+            if not has_default:
+                return OMIT
+            value = default
+        return table[value]
+
+    # Value of the field when the GCDocs field is missing
+    if 'missing' in spec:
+        missing = copy_value(spec['missing'])
+    elif spec.get('missing_datetime'):
+        missing_datetime = spec['missing_datetime']
+        missing = lambda fields: datetime.now().strftime(missing_datetime)
+    elif has_default:
+        missing = copy_value(default if table is None else table[default])
+    else:
+        missing = lambda fields: OMIT
+
+    if 'transform' not in spec and table is None:
+        return lambda fields: fields[source] if source in fields else missing(fields)
+
+    # Values already resolved by the transform and lookup, by GCDocs value. The same organizations, keywords
+    # and sections repeat across many documents. The {en, fr} values of pair transforms are copied for each record.
+    resolved = {}
+    copy = copy_result if spec.get('transform') in ('pair', 'pair_list') else lambda value: value
+
+    def map_field(fields):
+        if source not in fields:
+            return missing(fields)
+        value = fields[source]
+        result = resolved.get(value, resolved)
+        if result is resolved:
+            result = resolve(value)
+            if len(resolved) < CACHE_SIZE:
+                resolved[value] = result
+        return copy(result)
+    return map_field
+
+
+def compile_bilingual_field(spec):
+    """
+    :return: Function building an {en, fr} field from two GCDocs fields
+    """
+    sources = [('en', spec['en'], spec['fr']), ('fr', spec['fr'], spec['en'])]
+    fallback = spec.get('fallback', False)
+    required = spec.get('required')
+
+    def map_field(fields):
+        if required and spec['en'] not in fields and spec['fr'] not in fields:
+            raise MissingRequiredFieldException(required)
+        value = {}
+        for lang, source, other_source in sources:
+            if source in fields:
+                value[lang] = fields[source]
+            elif fallback and other_source in fields:
+                value[lang] = fields[other_source]
+        return value
+    return map_field
+
+
+def compile_field(spec, tables):
+    """
+    Compile one entry of the mapping file
+    :param spec: Mapping entry
+    :param tables: Lookup tables by name
+    :return: Tuple of the CKAN field name and a function mapping the GCDocs fields to its value
+    """
+    if 'value' in spec:
+        map_field = copy_value(spec['value'])
+    elif spec.get('transform') == 'bilingual':
+        map_field = compile_bilingual_field(spec)
+    else:
+        map_field = compile_source_field(spec, tables)
+
+    unless = spec.get('unless')
+    if unless:
+        map_value = map_field
+        map_field = lambda fields: OMIT if fields.get(unless, None) else map_value(fields)
+    return spec['field'], map_field
+
+
+def compile_mapping(mapping_file, tables):
+    """
+    Compile the GCDocs to CKAN field mapping. Constant text values and GCDocs fields copied as they are do
+    not need a function call for each record, so they are kept apart from the other fields.
+    :param mapping_file: Path to the mapping file, ex. schemas/doc_mapping.yaml
+    :param tables: Lookup tables by name
+    :return: Tuple of the dictionary of constant CKAN fields, the list of (CKAN field name, GCDocs field name)
+             tuples of the copied fields, and the list of (CKAN field name, transform function) tuples of the
+             other fields, in the order they are applied
+    """
+    with open(mapping_file, 'r') as mapping:
+        spec = yaml.load(mapping, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    constants = {}
+    copied = []
+    transforms = []
+    for field_spec in spec['dataset_fields']:
+        options = set(field_spec) - set(['field'])
+        if options == set(['value']) and not isinstance(field_spec['value'], (list, dict)):
+            constants[field_spec['field']] = field_spec['value']
+        elif options == set(['source']):
+            copied.append((field_spec['field'], field_spec['source']))
+        else:
+            transforms.append(compile_field(field_spec, tables))
+    return constants, copied, transforms
+
+
+def apply_mapping(mapping, fields, obd_ds):
+    """
+    Set the CKAN fields of a record from the GCDocs metadata in a single pass. Each CKAN field is set by a
+    single entry of the mapping.
+    :param mapping: Compiled mapping from compile_mapping()
+    :param fields: GCDocs metadata
+    :param obd_ds: CKAN record to update
+    :return: The CKAN record
+    """
+    constants, copied, transforms = mapping
+    obd_ds.update(constants)
+    for field_name, source in copied:
+        if source in fields:
+            obd_ds[field_name] = fields[source]
+    for field_name, map_field in transforms:
+        value = map_field(fields)
+        if value is not OMIT:
+            obd_ds[field_name] = value
+    return obd_ds
@@ -0,0 +1,130 @@
+
+import logging
+import marshal
+import os
+import sys
+import yaml
+
+logger = logging.getLogger('base')
+
+# Increase when the compiled tables change, so existing cache files are rebuilt
+CACHE_VERSION = 2
+
+SCHEMA_FILES = ['presets.yaml', 'doc.yaml']
+
+# Scheming validators checked by obd_validate.py, in order of precedence
+VALIDATOR_KINDS = ['fluent_tags', 'fluent_text', 'scheming_multiple_choice', 'scheming_choices', 'isodate',
+                   'email_validator', 'int_validator']
+
+# Name of the cache file kept in the schema directory, unless another path is given
+CACHE_FILE_NAME = '.presets-cache.marshal'
+
+
+def load_yaml(file_name):
+    with open(file_name, 'r') as yaml_file:
+        return yaml.load(yaml_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def compile_field_rules(field_specs, presets):
+    """
+    Build the validation rules of the fields of a scheming schema
+    :param field_specs: dataset_fields or resource_fields of the schema. Fields using a preset are merged with it.
+    :param presets: Preset values by preset name
+    :return: List of rules: field name, required flag, kind of validator and the allowed choices
+    """
+    rules = []
+    for spec in field_specs:
+        field = dict(presets.get(spec.get('preset'), {}))
+        field.update(spec)
+        validators = field.get('validators', '').split()
+        kind = None
+        for validator in VALIDATOR_KINDS:
+            if validator in validators:
+                kind = validator
+                break
+        choices = None
+        if 'choices' in field:
+            choices = [choice['value'] for choice in field['choices']]
+        rules.append({'field': field['field_name'],
+                      'required': bool(field.get('required')) or 'not_empty' in validators,
+                      'kind': kind,
+                      'choices': choices})
+    return rules
+
+
+def compile_lookup_tables(schema_dir):
+    """
+    Read the CKAN Open Canada scheming presets and build the lookup tables used by the conversion, and the
+    validation rules of the Open by Default schema
+    :param schema_dir: Directory holding presets.yaml and doc.yaml
+    :return: Dictionary of lookup tables
+    """
+    presets = load_yaml(os.path.join(schema_dir, 'presets.yaml'))
+    doc_schema = load_yaml(os.path.join(schema_dir, 'doc.yaml'))
+    resource_formats = {}
+    resource_types = {}
+    audience_types = {}
+    for rec in presets['presets']:
+        if rec['preset_name'] == 'canada_resource_format':
+            for choice in rec['values']['choices']:
+                assert isinstance(choice, dict)
+                if 'mimetype' in choice:
+                    resource_formats[choice['value']] = choice['mimetype']
+                else:
+                    resource_formats[choice['value']] = ''
+        elif rec['preset_name'] == 'canada_resource_type':
+            for choice in rec['values']['choices']:
+                resource_types[choice['label']['en']] = choice['value']
+        elif rec['preset_name'] == 'canada_audience':
+            for choice in rec['values']['choices']:
+                audience_types[choice['label']['en']] = choice['value']
+    preset_values = dict((rec['preset_name'], rec['values']) for rec in presets['presets'])
+    return {'resource_formats': resource_formats,
+            'resource_types': resource_types,
+            'audience_types': audience_types,
+            'form_languages': doc_schema['form_languages'],
+            'dataset_rules': compile_field_rules(doc_schema['dataset_fields'], preset_values),
+            'resource_rules': compile_field_rules(doc_schema['resource_fields'], preset_values)}
+
+
+def cache_key(schema_dir):
+    """
+    :return: Key identifying the current version of the schema files and of this module's tables
+    """
+    files = []
+    for schema_file in SCHEMA_FILES:
+        stat = os.stat(os.path.join(schema_dir, schema_file))
+        files.append((schema_file, stat.st_size, stat.st_mtime))
+    return CACHE_VERSION, sys.version, os.path.abspath(schema_dir), tuple(files)
+
+
+def load_lookup_tables(schema_dir='schemas', cache_file=None):
+    """
+    Get the lookup tables compiled from the scheming presets. The tables are kept in a cache file that is
+    rebuilt whenever a schema file changes, so the YAML presets are only parsed once. The cache file is only
+    readable by its owner.
+    :param schema_dir: Directory holding the schema files
+    :param cache_file: Path to the cache file, by default CACHE_FILE_NAME in the schema directory
+    :return: Dictionary of lookup tables
+    """
+    if cache_file is None:
+        cache_file = os.path.join(schema_dir, CACHE_FILE_NAME)
+    key = cache_key(schema_dir)
+    try:
+        with open(cache_file, 'rb') as cache:
+            cached_key, tables = marshal.load(cache)
+        if cached_key == key:
+            return tables
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+
+    tables = compile_lookup_tables(schema_dir)
+    try:
+        if os.path.lexists(cache_file + '.part'):
+            os.remove(cache_file + '.part')
+        with os.fdopen(os.open(cache_file + '.part', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as cache:
+            marshal.dump((key, tables), cache)
+        os.rename(cache_file + '.part', cache_file)
+    except (IOError, OSError) as ex:
+        logger.warn('Unable to save the presets cache {0}: {1}'.format(cache_file, ex))
+    return tables
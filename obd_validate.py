@@ -0,0 +1,110 @@
+
+import re
+from obd_dates import parse_date
+
+# Loose check of the e-mail addresses accepted by the CKAN email_validator
+EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def is_empty(value):
+    return value is None or value == '' or value == [] or value == {}
+
+
+def is_text(value):
+    return isinstance(value, basestring)
+
+
+class PackageValidator(object):
+    """
+    Check converted CKAN packages against the rules compiled from the Open by Default scheming schema
+    (schemas/doc.yaml and schemas/presets.yaml), so records CKAN would refuse are caught before the upload.
+    Only the validators that apply to the converted records are checked: required fields, choices,
+    fluent bilingual fields, dates, e-mail addresses and integers.
+    """
+
+    def __init__(self, tables):
+        """
+        :param tables: Lookup tables from obd_presets.load_lookup_tables()
+        """
+        self.languages = tables['form_languages']
+        self.dataset_rules = [self.compile_rule(rule) for rule in tables['dataset_rules']]
+        self.resource_rules = [self.compile_rule(rule) for rule in tables['resource_rules']]
+
+    def compile_rule(self, rule):
+        """
+        :return: Tuple of the field name, required flag and a function returning the error for a value, or None
+        """
+        kind = rule['kind']
+        choices = frozenset(rule['choices'] or [])
+        required = rule['required']
+
+        if kind == 'fluent_text':
+            check = lambda value: self.check_fluent(value, required, is_text)
+        elif kind == 'fluent_tags':
+            check = lambda value: self.check_fluent(
+                value, required, lambda tags: isinstance(tags, list) and all(is_text(t) and t for t in tags))
+        elif kind == 'scheming_choices':
+            check = lambda value: None if value in choices else 'unexpected choice {0}'.format(value)
+        elif kind == 'scheming_multiple_choice':
+            def check(value):
+                values = value if isinstance(value, list) else [value]
+                unexpected = [v for v in values if v not in choices]
+                if unexpected:
+                    return 'unexpected choices {0}'.format(', '.join(unicode(v) for v in unexpected))
+        elif kind == 'isodate':
+            def check(value):
+                try:
+                    parse_date(value)
+                except (ValueError, TypeError, OverflowError):
+                    return 'invalid date {0}'.format(value)
+        elif kind == 'email_validator':
+            check = lambda value: None if is_text(value) and EMAIL.match(value) else 'invalid e-mail address'
+        elif kind == 'int_validator':
+            def check(value):
+                try:
+                    int(value)
+                except (ValueError, TypeError):
+                    return 'invalid integer {0}'.format(value)
+        else:
+            check = lambda value: None
+        return rule['field'], required, check
+
+    def check_fluent(self, value, required, check_language):
+        if not isinstance(value, dict):
+            return 'expected a value for each of {0}'.format(', '.join(self.languages))
+        unexpected = [lang for lang in value if lang not in self.languages]
+        if unexpected:
+            return 'unexpected languages {0}'.format(', '.join(unexpected))
+        for lang in self.languages:
+            if is_empty(value.get(lang)):
+                if required:
+                    return 'missing {0} value'.format(lang)
+            elif not check_language(value[lang]):
+                return 'invalid {0} value'.format(lang)
+
+    @staticmethod
+    def check_fields(rules, record, prefix, errors):
+        for field_name, required, check in rules:
+            value = record.get(field_name)
+            if is_empty(value):
+                if required:
+                    errors.append('{0}{1}: missing value'.format(prefix, field_name))
+                continue
+            error = check(value)
+            if error:
+                errors.append('{0}{1}: {2}'.format(prefix, field_name, error))
+
+    def validate(self, obd_ds):
+        """
+        Validate a converted package. Expired packages are only used to delete the CKAN record, and are not
+        checked.
+        :param obd_ds: CKAN package from convert()
+        :return: List of error messages, empty if the package is valid
+        """
+        errors = []
+        if 'type' not in obd_ds:
+            return errors
+        self.check_fields(self.dataset_rules, obd_ds, '', errors)
+        for i, resource in enumerate(obd_ds.get('resources', [])):
+            self.check_fields(self.resource_rules, resource, 'resources[{0}].'.format(i), errors)
+        return errors
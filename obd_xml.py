@@ -0,0 +1,99 @@
+
+import logging
+import traceback
+from lxml import etree
+
+logger = logging.getLogger('base')
+
+# Path to the properties element read from a GCDocs enterprise library export, and the only tags the
+# streaming parser needs events for
+PROPERTIES_PATH = ['enterpriseLibrary', 'application', 'parent', 'item', 'variants', 'variant', 'properties']
+STREAM_TAGS = ('properties', 'property', 'propertyGroup', 'propertyRow')
+
+
+def read_xml(filename):
+    '''
+    Read a GCDocs XML metadata export file, and convert the information to a generic object.
+    The file is parsed as a stream and each element is discarded once it has been read, so memory use
+    does not grow with the size of the customMetadata groups.
+    :param filename: The path to the XML file, or a file-like object, to read
+    :return: A python dictionary keyed on the dictionary name
+    '''
+    refs = {}
+    properties = None
+    try:
+        for event, elem in etree.iterparse(filename, events=('start', 'end'), tag=STREAM_TAGS, huge_tree=True):
+            if event == 'start':
+                if properties is None and elem.tag == 'properties':
+                    path = [e.tag for e in elem.iterancestors()][::-1] + [elem.tag]
+                    if path == PROPERTIES_PATH:
+                        properties = elem
+                    else:
+                        assert (path[0] == "enterpriseLibrary")
+                elif elem.tag == 'propertyGroup' and elem.getparent() is properties:
+                    assert (elem.attrib['name'] == 'customMetadata')
+                continue
+
+            parent = elem.getparent()
+            if elem.tag == 'property':
+                if parent is properties:
+                    if elem.find('value').text:
+                        refs[elem.attrib['name']] = elem.find('value').text
+                elif parent.tag == 'propertyRow':
+                    # Row properties are read when the row ends
+                    continue
+            elif elem.tag == 'propertyRow':
+                if parent.getparent() is properties:
+                    r = {}
+                    for l in elem.iterchildren('property'):
+                        r[l.attrib['name']] = l.find('value').text
+                    if r['metadata'] and r['attribute']:
+                        refs[r['attribute']] = r['metadata']
+            elif elem is properties:
+                # Only the first variant is used, the rest of the file can be skipped
+                break
+
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    except etree.XMLSyntaxError as xe:
+        logger.error(xe.message)
+        logger.error(traceback.format_exc())
+        return None
+
+    return refs
+
+
+def read_xml_tree(filename):
+    '''
+    Read a GCDocs XML metadata export file by loading the whole document tree. This was the original
+    parser and is kept as a reference for read_xml().
+    :param filename: The path to the XML file to read
+    :return: A python dictionary keyed on the dictionary name
+    '''
+    try:
+        root = etree.parse(filename).getroot()
+    except etree.XMLSyntaxError as xe:
+        logger.error(xe.message)
+        logger.error(traceback.format_exc())
+        return None
+
+    refs = {}
+    assert (root.tag == "enterpriseLibrary")
+    variant = root.find('application').find('parent').find('item').find(
+        'variants').find('variant')
+    start = variant.find('properties')
+
+    for l in start.findall('property'):
+        if l.find('value').text:
+            refs[l.attrib['name']] = l.find('value').text
+    for c in start.findall('propertyGroup'):
+        assert (c.attrib['name'] == 'customMetadata')
+        for row in c.findall('propertyRow'):
+            r = {}
+            for l in row.findall('property'):
+                r[l.attrib['name']] = l.find('value').text
+            if r['metadata'] and r['attribute']:
+                refs[r['attribute']] = r['metadata']
+
+    return refs